@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/local/munki/munki-python
 # encoding: utf-8
 
 # ================================================================================
@@ -22,10 +22,33 @@
 # There is also a JSON file in the above directory, whose contents may be easier 
 # to copy into Python.
 #
+# Rather than copying them, either file can be compiled into a compatibility
+# index with --import-assets, for Big Sur and any later release. The script then
+# checks the machine against every release it knows about in one run, and sets
+# a condition per release (bigsur_supported, monterey_supported, ...). The Big
+# Sur data below is built in, and used when there is no index.
+#
+# With --inventory, the same checks run offline over an inventory export (CSV,
+# JSON or JSON lines with model, board-id, OS version and VM columns) instead of
+# this Mac, on any platform. It writes the conditions per machine and the number
+# of supported machines per model.
+#
+# All facts about the machine are collected up front in one pass: a single
+# sysctl call, one ioreg call (read as a plist) and direct reads of the plists
+# that were previously queried through defaults and pkgutil. The parsers only
+# take the output of these commands, so they can be checked against captured
+# output on any platform.
+#
+# The hardware facts (model, board-id, CPU features, VM status) can't change
+# without a reboot, so they are cached in a plist together with an ID of the
+# current boot session. Later runs in the same boot read that plist instead of
+# running sysctl and ioreg. Pass --refresh-facts to probe the hardware again.
+#
 # The checks done by this script are (in order):
 # - Machine is a virtual machine or has a specific supported board-id
 # - Machine model is not in a list of unsupported models
-# - Current system version is less than 11.0 (10.16) and at least 10.9
+# - Current system version is less than the release (11.0 or 10.16 for Big Sur)
+#   and at least its minimum version, if it has one (10.9 for Big Sur)
 #
 # Exit codes:
 # 0 = Big Sur is supported
@@ -42,9 +65,16 @@
 import sys
 import subprocess
 import os
-import re
 import plistlib
-from distutils.version import StrictVersion
+import collections
+import datetime
+import optparse
+import tempfile
+import json
+import csv
+import itertools
+import fcntl
+import xml.parsers.expat
 
 
 # ================================================================================
@@ -54,215 +84,163 @@ from distutils.version import StrictVersion
 # Set this to False if you don't want any output, just the exit codes
 verbose = True
 
-# Set this to True if you want to add "bigsur_supported" custom conditional to
-# /Library/Managed Installs/ConditionalItems.plist
+# Set this to True if you want to add the "bigsur_supported" custom conditional
+# (and one for every other known release) to ConditionalItems.plist in the
+# ManagedInstallDir, /Library/Managed Installs by default. The file is only
+# written when a value changed.
 update_munki_conditional_items = False
 
+# Where to cache hardware facts between runs, and for how many seconds they
+# can be reused within the same boot. Set the TTL to 0 to always probe.
+facts_cache_path = "/Library/Managed Installs/HardwareFacts.plist"
+facts_cache_ttl = 7 * 24 * 60 * 60
+
+# Releases compiled from Apple's asset catalogs with --import-assets, in
+# addition to the built-in Big Sur data. The exit code is for exit_code_release.
+compatibility_index_path = "/Library/Managed Installs/CompatibilityIndex.json"
+exit_code_release = "bigsur"
+
 # ================================================================================
 # End configuration
 # ================================================================================
 
-
-def logger(message, status, info):
-    if verbose:
-        print "%14s: %-40s [%s]" % (message, status, info)
-    pass
-
-
-def conditional_items_path():
-    # <https://github.com/munki/munki/wiki/Conditional-Items>
-    # Read the location of the ManagedInstallDir from ManagedInstall.plist
-    
-    cmd = [
-        "/usr/bin/defaults",
-        "read",
-        "/Library/Preferences/ManagedInstalls",
-        "ManagedInstallDir"
-    ]
-    p = subprocess.Popen(cmd, bufsize=1, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (results, err) = p.communicate()
-    managed_installs_dir = results.strip()
-    
-    # Make sure we're outputting our information to "ConditionalItems.plist"
-    if managed_installs_dir:
-        return os.path.join(managed_installs_dir, 'ConditionalItems.plist')
-    else:
-        # Munki default
-        return "/Library/Managed Installs/ConditionalItems.plist"
-
-
-def munki_installed():
-    cmd = ["pkgutil", "--pkg-info", "com.googlecode.munki.core"]
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output = p.communicate()[0]
-    if p.returncode == 0:
-        return True
-    else:
-        return False
-
-
-def is_system_version_supported():
-    system_version_plist = plistlib.readPlist("/System/Library/CoreServices/SystemVersion.plist")
-    product_name = system_version_plist['ProductName']
-    product_version = system_version_plist['ProductVersion']
-    if StrictVersion(product_version) >= StrictVersion('10.16'):
-        logger("System",
-               "%s %s" % (product_name, product_version),
-               "Failed")
-        return False
-    elif StrictVersion(product_version) >= StrictVersion('10.9'):
-        logger("System",
-               "%s %s" % (product_name, product_version),
-               "OK")
-        return True
-    else:
-        logger("System",
-               "%s %s" % (product_name, product_version),
-               "Failed")
-        return False
-
-
-def get_board_id():
-    """Gets the local device ID on Apple Silicon Macs or the board_id of older Macs"""
-    ioreg_cmd = ["/usr/sbin/ioreg", "-c", "IOPlatformExpertDevice", "-d", "2"]
-    try:
-        ioreg_output = subprocess.check_output(ioreg_cmd).splitlines()
-        board_id = ""
-        device_id = ""
-        for line in ioreg_output:
-            line_decoded = line.decode("utf8")
-            if "board-id" in line_decoded:
-                board_id = line_decoded.split("<")[-1]
-                board_id = board_id[
-                    board_id.find('<"') + 2 : board_id.find('">')  # noqa: E203
-                ]
-            elif "compatible" in line_decoded:
-                device_details = line_decoded.split("<")[-1]
-                device_details = device_details[
-                    device_details.find("<")
-                    + 2 : device_details.find(">")  # noqa: E203
-                ]
-                device_id = (
-                    device_details.replace('","', ";").replace('"', "").split(";")[0]
-                )
-        if board_id:
-            return board_id
-        elif device_id:
-            return device_id
-    except subprocess.CalledProcessError as err:
-        raise ReplicationError(err)
-
-
-def is_virtual_machine():
-    cmd = ["/usr/sbin/sysctl", "-n", "machdep.cpu.features"]
-    p = subprocess.Popen(cmd, bufsize=1, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (results, err) = p.communicate()
-    for feature in results.split():
-        if feature == "VMM":
-            logger("Board ID",
-                   "Virtual machine",
-                   "OK")
-            return True
-    return False
-
-
-def get_current_model():
-    cmd = ["/usr/sbin/sysctl", "-n", "hw.model"]
-    p = subprocess.Popen(cmd, bufsize=1, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (results, err) = p.communicate()
-    return results.strip()
-
-
-def is_supported_model():
-    non_supported_models = [
-        'iMac4,1',
-        'iMac4,2',
-        'iMac5,1',
-        'iMac5,2',
-        'iMac6,1',
-        'iMac7,1',
-        'iMac8,1',
-        'iMac9,1',
-        'iMac10,1',
-        'iMac11,1',
-        'iMac11,2',
-        'iMac11,3',
-        'iMac12,1',
-        'iMac12,2',
-        'iMac13,1',
-        'iMac13,2',
-        'iMac14,1',
-        'iMac14,2',
-        'MacBook1,1',
-        'MacBook2,1',
-        'MacBook3,1',
-        'MacBook4,1',
-        'MacBook5,1',
-        'MacBook5,2',
-        'MacBook6,1',
-        'MacBook7,1',
-        'MacBookAir1,1',
-        'MacBookAir2,1',
-        'MacBookAir3,1',
-        'MacBookAir3,2',
-        'MacBookAir4,1',
-        'MacBookAir4,2',
-        'MacBookAir5,1',
-        'MacBookAir5,2',
-        'MacBookPro1,1',
-        'MacBookPro1,2',
-        'MacBookPro2,1',
-        'MacBookPro2,2',
-        'MacBookPro3,1',
-        'MacBookPro4,1',
-        'MacBookPro5,1',
-        'MacBookPro5,2',
-        'MacBookPro5,3',
-        'MacBookPro5,4',
-        'MacBookPro5,5',
-        'MacBookPro6,1',
-        'MacBookPro6,2',
-        'MacBookPro7,1',
-        'MacBookPro8,1',
-        'MacBookPro8,2',
-        'MacBookPro8,3',
-        'MacBookPro9,1',
-        'MacBookPro9,2',
-        'MacBookPro10,1',
-        'MacBookPro10,2',
-        'Macmini1,1',
-        'Macmini2,1',
-        'Macmini3,1',
-        'Macmini4,1',
-        'Macmini5,1',
-        'Macmini5,2',
-        'Macmini5,3',
-        'Macmini6,1',
-        'Macmini6,2',
-        'MacPro1,1',
-        'MacPro2,1',
-        'MacPro3,1',
-        'MacPro4,1',
-        'MacPro5,1',
-        'Xserve1,1',
-        'Xserve2,1',
-        'Xserve3,1',
-        ]
-    current_model = get_current_model()
-    if current_model in non_supported_models:
-        logger("Model",
-               "\"%s\" is not supported" % current_model,
-               "Failed")
-        return False
-    else:
-        logger("Model",
-               current_model,
-               "OK")
-        return True
-
-
-def is_supported_board_id():
-    platform_support_values = [
+SYSCTL_PATH = "/usr/sbin/sysctl"
+IOREG_PATH = "/usr/sbin/ioreg"
+SYSTEM_VERSION_PLIST = "/System/Library/CoreServices/SystemVersion.plist"
+MANAGED_INSTALLS_PLIST = "/Library/Preferences/ManagedInstalls.plist"
+MUNKI_CORE_RECEIPT = "/var/db/receipts/com.googlecode.munki.core.plist"
+DEFAULT_MANAGED_INSTALL_DIR = "/Library/Managed Installs"
+LINUX_BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+FACTS_CACHE_VERSION = 1
+
+# Everything is read with one sysctl call. kern.hv_vmm_present is set in
+# virtual machines on Apple Silicon, which have no machdep.cpu.features.
+SYSCTL_NAMES = ["hw.model", "machdep.cpu.features", "kern.hv_vmm_present"]
+
+# Facts that only change with a reboot, and can be cached
+HARDWARE_FACTS = ["model", "board_id", "cpu_features", "is_virtual_machine"]
+
+# A macOS release compiled for lookups: version and minimum_system_version
+# are parsed version tuples, board_ids and unsupported_models frozensets
+Release = collections.namedtuple("Release", [
+    "name",
+    "title",
+    "condition",
+    "version",
+    "minimum_system_version",
+    "board_ids",
+    "unsupported_models",
+])
+
+# Condition names and marketing names per major macOS version
+RELEASE_NAMES = {
+    11: ("bigsur", "Big Sur"),
+    12: ("monterey", "Monterey"),
+    13: ("ventura", "Ventura"),
+    14: ("sonoma", "Sonoma"),
+    15: ("sequoia", "Sequoia"),
+    26: ("tahoe", "Tahoe"),
+}
+
+# Asset keys that hold the OS version, and the oldest OS that can upgrade
+ASSET_VERSION_KEYS = ["OSVersion", "ProductVersion"]
+ASSET_MINIMUM_VERSION_KEYS = ["MinimumSystemVersion", "MinimumOSVersion"]
+INDEX_VERSION = 1
+
+# Accepted column names in inventory exports, compared in lower case
+INVENTORY_COLUMNS = {
+    "model": ["model", "hw.model", "model_identifier", "modelidentifier"],
+    "board_id": ["board_id", "board-id", "boardid"],
+    "product_version": ["os_version", "osversion", "product_version", "productversion"],
+    "is_virtual_machine": ["is_virtual_machine", "virtual_machine", "vm"],
+}
+TRUE_VALUES = frozenset(["1", "true", "yes", "y"])
+
+# Immutable snapshot of everything the checks need to know about the machine
+Facts = collections.namedtuple("Facts", HARDWARE_FACTS + [
+    "product_name",
+    "product_version",
+    "munki_installed",
+    "managed_install_dir",
+])
+
+
+BIG_SUR_UNSUPPORTED_MODELS = [
+    'iMac4,1',
+    'iMac4,2',
+    'iMac5,1',
+    'iMac5,2',
+    'iMac6,1',
+    'iMac7,1',
+    'iMac8,1',
+    'iMac9,1',
+    'iMac10,1',
+    'iMac11,1',
+    'iMac11,2',
+    'iMac11,3',
+    'iMac12,1',
+    'iMac12,2',
+    'iMac13,1',
+    'iMac13,2',
+    'iMac14,1',
+    'iMac14,2',
+    'MacBook1,1',
+    'MacBook2,1',
+    'MacBook3,1',
+    'MacBook4,1',
+    'MacBook5,1',
+    'MacBook5,2',
+    'MacBook6,1',
+    'MacBook7,1',
+    'MacBookAir1,1',
+    'MacBookAir2,1',
+    'MacBookAir3,1',
+    'MacBookAir3,2',
+    'MacBookAir4,1',
+    'MacBookAir4,2',
+    'MacBookAir5,1',
+    'MacBookAir5,2',
+    'MacBookPro1,1',
+    'MacBookPro1,2',
+    'MacBookPro2,1',
+    'MacBookPro2,2',
+    'MacBookPro3,1',
+    'MacBookPro4,1',
+    'MacBookPro5,1',
+    'MacBookPro5,2',
+    'MacBookPro5,3',
+    'MacBookPro5,4',
+    'MacBookPro5,5',
+    'MacBookPro6,1',
+    'MacBookPro6,2',
+    'MacBookPro7,1',
+    'MacBookPro8,1',
+    'MacBookPro8,2',
+    'MacBookPro8,3',
+    'MacBookPro9,1',
+    'MacBookPro9,2',
+    'MacBookPro10,1',
+    'MacBookPro10,2',
+    'Macmini1,1',
+    'Macmini2,1',
+    'Macmini3,1',
+    'Macmini4,1',
+    'Macmini5,1',
+    'Macmini5,2',
+    'Macmini5,3',
+    'Macmini6,1',
+    'Macmini6,2',
+    'MacPro1,1',
+    'MacPro2,1',
+    'MacPro3,1',
+    'MacPro4,1',
+    'MacPro5,1',
+    'Xserve1,1',
+    'Xserve2,1',
+    'Xserve3,1',
+]
+
+BIG_SUR_BOARD_IDS = [
     'J132AP',
     'J137AP',
     'J140AAP',
@@ -351,10 +329,300 @@ def is_supported_board_id():
     'Mac-F305150B0C7DEEEF',
     'Mac-F60DEB81FF30ACF6',
     'Mac-FA842E06C61E91C5',
-    'Mac-FFE5EF870D7BA81A'
-    ]
-    board_id = get_board_id()
-    if board_id in platform_support_values:
+    'Mac-FFE5EF870D7BA81A',
+]
+
+# Releases known without an index, in the same format as the index
+BUILTIN_RELEASES = [
+    {
+        "name": "bigsur",
+        "version": "11",
+        "minimum_system_version": "10.9",
+        "board_ids": BIG_SUR_BOARD_IDS,
+        "unsupported_models": BIG_SUR_UNSUPPORTED_MODELS,
+    },
+]
+
+
+def logger(message, status, info):
+    if verbose:
+        print("%14s: %-40s [%s]" % (message, status, info))
+    pass
+
+
+def parse_sysctl_output(output):
+    """Parses the "name: value" lines of sysctl into a dict. Unknown names
+    are reported on stderr by sysctl, so they're simply missing."""
+    values = {}
+    for line in output.splitlines():
+        name, separator, value = line.partition(": ")
+        if separator:
+            values[name.strip()] = value.strip()
+    return values
+
+
+def decode_ioreg_value(value):
+    # ioreg -a returns most properties as data, NUL-terminated
+    if isinstance(value, bytes):
+        value = value.decode("utf8", "replace")
+    return value.rstrip("\0")
+
+
+def parse_ioreg_board_id(output):
+    """Gets the board-id of older Macs, or the device ID of Apple Silicon Macs
+    (the first "compatible" value), from `ioreg -a -c IOPlatformExpertDevice`."""
+    try:
+        root = plistlib.loads(output)
+    except Exception:
+        return ""
+    # Breadth first, so the platform device is found before its children
+    queue = collections.deque([root])
+    while queue:
+        node = queue.popleft()
+        if isinstance(node, dict):
+            if "board-id" in node:
+                return decode_ioreg_value(node["board-id"])
+            if "compatible" in node:
+                compatible = node["compatible"]
+                if isinstance(compatible, list):
+                    compatible = compatible[0] if compatible else ""
+                return decode_ioreg_value(compatible).split("\0")[0]
+            queue.extend(node.get("IORegistryEntryChildren", []))
+        elif isinstance(node, list):
+            queue.extend(node)
+    return ""
+
+
+def parse_hardware_facts(sysctl_output, ioreg_output):
+    """Returns a dict of the HARDWARE_FACTS from captured sysctl and ioreg output"""
+    sysctl_values = parse_sysctl_output(sysctl_output)
+    cpu_features = frozenset(sysctl_values.get("machdep.cpu.features", "").split())
+    return {
+        "model": sysctl_values.get("hw.model", ""),
+        "board_id": parse_ioreg_board_id(ioreg_output),
+        "cpu_features": cpu_features,
+        "is_virtual_machine": "VMM" in cpu_features or sysctl_values.get("kern.hv_vmm_present") == "1",
+    }
+
+
+def build_facts(hardware_facts, system_version, managed_installs, munki_installed):
+    """Builds Facts from the hardware facts and the contents of
+    SystemVersion.plist and ManagedInstalls.plist (dicts, may be empty)."""
+    return Facts(
+        product_name=system_version.get("ProductName", ""),
+        product_version=system_version.get("ProductVersion", ""),
+        munki_installed=munki_installed,
+        managed_install_dir=managed_installs.get("ManagedInstallDir") or DEFAULT_MANAGED_INSTALL_DIR,
+        **hardware_facts
+    )
+
+
+def run_command(cmd):
+    # Returns stdout even if the command failed, sysctl exits non-zero on unknown names
+    try:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return b""
+    (results, err) = p.communicate()
+    return results
+
+
+def read_plist(path):
+    # Missing and unparseable files both read as empty: XML errors surface as
+    # ExpatError and binary ones as InvalidFileException, a ValueError
+    try:
+        with open(path, "rb") as f:
+            return plistlib.load(f)
+    except (OSError, ValueError, xml.parsers.expat.ExpatError):
+        return {}
+
+
+def probe_hardware_facts():
+    """Gathers the hardware facts with one sysctl and one ioreg call"""
+    sysctl_output = run_command([SYSCTL_PATH] + SYSCTL_NAMES).decode("utf8", "replace")
+    ioreg_output = run_command([IOREG_PATH, "-a", "-c", "IOPlatformExpertDevice", "-d", "2"])
+    return parse_hardware_facts(sysctl_output, ioreg_output)
+
+
+def get_boot_session():
+    """Identifies the current boot without spawning a process: the
+    kern.bootsessionuuid sysctl on macOS, boot_id on Linux. None if unknown."""
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"))
+        size = ctypes.c_size_t(64)
+        buffer = ctypes.create_string_buffer(size.value)
+        if libc.sysctlbyname(b"kern.bootsessionuuid", buffer, ctypes.byref(size), None, ctypes.c_size_t(0)) == 0:
+            return buffer.value.decode("utf8")
+    except (OSError, AttributeError):
+        pass
+    try:
+        with open(LINUX_BOOT_ID_PATH, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+class FactsCache(object):
+    """
+    Hardware facts stored in a plist, valid for ttl seconds and only within
+    the boot session they were collected in.
+    """
+
+    def __init__(self, path, ttl, boot_session):
+        self.path = path
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.boot_session = boot_session
+
+    def is_enabled(self):
+        return bool(self.path) and self.ttl.total_seconds() > 0 and self.boot_session is not None
+
+    def load(self, now):
+        # Returns the cached hardware facts as a dict, or None
+        if not self.is_enabled():
+            return None
+        cached = read_plist(self.path)
+        try:
+            if (cached["version"] != FACTS_CACHE_VERSION or cached["boot_session"] != self.boot_session
+                    or not cached["collected"] <= now < cached["collected"] + self.ttl):
+                return None
+            hardware_facts = dict((name, cached["facts"][name]) for name in HARDWARE_FACTS)
+        except (KeyError, TypeError):
+            return None
+        hardware_facts["cpu_features"] = frozenset(hardware_facts["cpu_features"])
+        return hardware_facts
+
+    def save(self, hardware_facts, now):
+        if not self.is_enabled():
+            return
+        facts = dict(hardware_facts, cpu_features=sorted(hardware_facts["cpu_features"]))
+        cached = {
+            "version": FACTS_CACHE_VERSION,
+            "boot_session": self.boot_session,
+            "collected": now,
+            "facts": facts,
+        }
+        # Other runs may be reading it. Failing to cache isn't fatal.
+        try:
+            write_file_atomically(self.path, plistlib.dumps(cached))
+        except OSError:
+            pass
+
+
+def write_file_atomically(path, data):
+    # Write to a temp file next to path and rename it into place, so readers
+    # never see a partial file
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=".%s." % os.path.basename(path), dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def get_hardware_facts(cache, refresh=False):
+    """Cached hardware facts if they are still valid, otherwise probes them
+    and updates the cache. refresh always probes."""
+    # Plist dates have no time zone and no microseconds
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, microsecond=0)
+    hardware_facts = None if refresh else cache.load(now)
+    if hardware_facts is None:
+        hardware_facts = probe_hardware_facts()
+        cache.save(hardware_facts, now)
+    return hardware_facts
+
+
+def collect_facts(cache, refresh=False):
+    return build_facts(get_hardware_facts(cache, refresh),
+                       read_plist(SYSTEM_VERSION_PLIST),
+                       read_plist(MANAGED_INSTALLS_PLIST),
+                       os.path.exists(MUNKI_CORE_RECEIPT))
+
+
+def conditional_items_path(facts):
+    # <https://github.com/munki/munki/wiki/Conditional-Items>
+    # Make sure we're outputting our information to "ConditionalItems.plist"
+    return os.path.join(facts.managed_install_dir, 'ConditionalItems.plist')
+
+
+def parse_version(version):
+    # "10.15.7" -> (10, 15, 7), ignoring anything that isn't a number
+    parts = []
+    for part in version.split("."):
+        digits = ""
+        for character in part:
+            if not character.isdigit():
+                break
+            digits += character
+        parts.append(int(digits or 0))
+    while len(parts) > 1 and parts[-1] == 0:
+        parts.pop()
+    return tuple(parts)
+
+
+def get_upgrade_version(product_version):
+    # macOS 11 and later report 10.16 to software that asks in compatibility mode
+    version = parse_version(product_version)
+    if version[:2] == (10, 16):
+        return (11,) + version[2:]
+    return version
+
+
+def is_system_version_supported(facts, release):
+    # The system can be upgraded: it's older than the release and at least its minimum version
+    product_name = facts.product_name
+    product_version = facts.product_version
+    version = get_upgrade_version(product_version)
+    if version >= release.version:
+        logger("System",
+               "%s %s" % (product_name, product_version),
+               "Failed")
+        return False
+    elif release.minimum_system_version is None or version >= release.minimum_system_version:
+        logger("System",
+               "%s %s" % (product_name, product_version),
+               "OK")
+        return True
+    else:
+        logger("System",
+               "%s %s" % (product_name, product_version),
+               "Failed")
+        return False
+
+
+def is_virtual_machine(facts):
+    if facts.is_virtual_machine:
+        logger("Board ID",
+               "Virtual machine",
+               "OK")
+        return True
+    return False
+
+
+def is_supported_model(facts, release):
+    current_model = facts.model
+    if current_model in release.unsupported_models:
+        logger("Model",
+               "\"%s\" is not supported" % current_model,
+               "Failed")
+        return False
+    else:
+        logger("Model",
+               current_model,
+               "OK")
+        return True
+
+
+def is_supported_board_id(facts, release):
+    board_id = facts.board_id
+    if board_id in release.board_ids:
         logger("Board ID",
                board_id,
                "OK")
@@ -366,44 +634,298 @@ def is_supported_board_id():
         return False
 
 
-def append_conditional_items(dictionary):
-    current_conditional_items_path = conditional_items_path()
-    if os.path.exists(current_conditional_items_path):
-        existing_dict = plistlib.readPlist(current_conditional_items_path)
-        output_dict = dict(existing_dict.items() + dictionary.items())
+def is_release_supported(facts, release):
+    logger("Release", release.title, release.condition)
+    # Every check runs, so each of them is logged
+    model_passed = is_supported_model(facts, release)
+    board_id_passed = is_supported_board_id(facts, release)
+    system_version_passed = is_system_version_supported(facts, release)
+    if is_virtual_machine(facts):
+        return True
+    return model_passed and board_id_passed and system_version_passed
+
+
+def evaluate_releases(facts, releases):
+    """Evaluates the machine against every release, returns a dict of
+    conditions, e.g. {'bigsur_supported': True, 'monterey_supported': False}"""
+    return dict((release.condition, is_release_supported(facts, release)) for release in releases)
+
+
+def compile_release(definition):
+    """Compiles a release definition (as in BUILTIN_RELEASES or the index)
+    into a Release with frozensets for the lookups"""
+    major = int(parse_version(str(definition["version"]))[0])
+    name, marketing_name = RELEASE_NAMES.get(major, ("macos%d" % major, None))
+    name = definition.get("name") or name
+    minimum_system_version = definition.get("minimum_system_version")
+    return Release(
+        name=name,
+        title="macOS %d %s" % (major, marketing_name) if marketing_name else "macOS %d" % major,
+        condition="%s_supported" % name,
+        version=parse_version(str(definition["version"])),
+        minimum_system_version=parse_version(minimum_system_version) if minimum_system_version else None,
+        board_ids=frozenset(definition.get("board_ids") or ()),
+        unsupported_models=frozenset(definition.get("unsupported_models") or ()),
+    )
+
+
+def get_asset_version(asset):
+    for key in ASSET_VERSION_KEYS:
+        if asset.get(key):
+            return str(asset[key])
+    return None
+
+
+def compile_assets(catalogs):
+    """Turns com_apple_MobileAsset_MacSoftwareUpdate catalogs (parsed XML or
+    JSON) into release definitions, one per major macOS version, with the
+    supported devices of all its assets"""
+    releases = {}
+    for catalog in catalogs:
+        for asset in catalog.get("Assets", []):
+            version = get_asset_version(asset)
+            devices = asset.get("SupportedDevices")
+            if not version or not devices:
+                continue
+            # Big Sur assets can be versioned 10.16, they belong to macOS 11
+            major = get_upgrade_version(version)[0]
+            release = releases.setdefault(major, {"version": str(major), "board_ids": set()})
+            release["board_ids"].update(devices)
+            for key in ASSET_MINIMUM_VERSION_KEYS:
+                if asset.get(key):
+                    # Assets of one release can disagree, the lowest minimum is the one that holds
+                    minimum = str(asset[key])
+                    current = release.get("minimum_system_version")
+                    if current is None or parse_version(minimum) < parse_version(current):
+                        release["minimum_system_version"] = minimum
+    definitions = []
+    for major in sorted(releases):
+        definition = releases[major]
+        definition["board_ids"] = sorted(definition["board_ids"])
+        definitions.append(definition)
+    return definitions
+
+
+def read_asset_catalog(path):
+    # The catalog comes as XML plist or JSON, with the same structure
+    with open(path, "rb") as f:
+        data = f.read()
+    if data.lstrip().startswith(b"{"):
+        return json.loads(data.decode("utf8"))
+    return plistlib.loads(data)
+
+
+def write_index(path, definitions):
+    index = {"version": INDEX_VERSION, "releases": definitions}
+    write_file_atomically(path, json.dumps(index, sort_keys=True, separators=(",", ":")).encode("utf8"))
+
+
+def load_releases(index_path):
+    """The built-in releases, updated with the releases in the index if there
+    is one. Values in the index override the built-in ones for a release."""
+    definitions = collections.OrderedDict(
+        (parse_version(definition["version"])[0], dict(definition)) for definition in BUILTIN_RELEASES)
+    try:
+        with open(index_path, "r") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    if index.get("version") == INDEX_VERSION:
+        for definition in index.get("releases", []):
+            major = parse_version(str(definition["version"]))[0]
+            merged = definitions.setdefault(major, {})
+            merged.update((key, value) for key, value in definition.items() if value)
+    return [compile_release(definitions[major]) for major in sorted(definitions)]
+
+
+def read_inventory(f):
+    """Yields the machines in a CSV, JSON or JSON lines inventory export as
+    dicts, one at a time except for JSON arrays"""
+    first = f.read(1)
+    while first.isspace():
+        first = f.read(1)
+    if first == "[":
+        for machine in json.loads(first + f.read()):
+            yield machine
+        return
+    # Put back the character that was peeked at
+    lines = itertools.chain([first + f.readline()], f)
+    if first == "{":
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
     else:
-        output_dict = dictionary
-    plistlib.writePlist(output_dict, current_conditional_items_path)
-    pass
+        for machine in csv.DictReader(lines):
+            yield machine
+
+
+def get_inventory_columns(machine):
+    # Maps each fact to the column that holds it in this export
+    columns = {}
+    by_lower_name = dict((str(name).lower(), name) for name in machine)
+    for fact, names in INVENTORY_COLUMNS.items():
+        for name in names:
+            if name in by_lower_name:
+                columns[fact] = by_lower_name[name]
+                break
+    return columns
+
+
+def get_inventory_facts(machine, columns):
+    def value(fact):
+        return machine.get(columns[fact]) if fact in columns else None
+    is_vm = value("is_virtual_machine")
+    return Facts(
+        model=str(value("model") or ""),
+        board_id=str(value("board_id") or ""),
+        cpu_features=frozenset(),
+        is_virtual_machine=is_vm is True or str(is_vm).strip().lower() in TRUE_VALUES,
+        product_name="",
+        product_version=str(value("product_version") or ""),
+        munki_installed=False,
+        managed_install_dir="",
+    )
+
+
+def evaluate_inventory(machines, releases):
+    """Yields (machine, facts, conditions) for every machine, without probing anything.
+    Machines with the same facts share one evaluation, so large fleets with a
+    few hundred distinct configurations only cost a dict lookup per machine."""
+    evaluated = {}
+    columns = None
+    for machine in machines:
+        if columns is None:
+            columns = get_inventory_columns(machine)
+        facts = get_inventory_facts(machine, columns)
+        conditions = evaluated.get(facts)
+        if conditions is None:
+            conditions = evaluated[facts] = evaluate_releases(facts, releases)
+        yield machine, facts, conditions
+
+
+def run_inventory(inventory_path, results_path, summary_path, releases):
+    """Evaluates an inventory export. Writes a CSV with every machine and its
+    conditions, and the number of machines and supported machines per model."""
+    global verbose
+    verbose = False
+    conditions_names = [release.condition for release in releases]
+    summary = collections.OrderedDict()
+    inventory_file = sys.stdin if inventory_path == "-" else open(inventory_path, "r", newline="")
+    results_file = sys.stdout if results_path == "-" else open(results_path, "w", newline="")
+    try:
+        writer = None
+        for machine, facts, conditions in evaluate_inventory(read_inventory(inventory_file), releases):
+            if writer is None:
+                writer = csv.DictWriter(results_file, list(machine) + conditions_names, extrasaction="ignore")
+                writer.writeheader()
+            row = dict(machine)
+            row.update(conditions)
+            writer.writerow(row)
+            counts = summary.setdefault(facts.model, [0] * (len(conditions_names) + 1))
+            counts[0] += 1
+            for index, name in enumerate(conditions_names):
+                counts[index + 1] += conditions[name]
+    finally:
+        if inventory_file is not sys.stdin:
+            inventory_file.close()
+        if results_file is not sys.stdout:
+            results_file.close()
+
+    summary_file = sys.stderr if summary_path is None else open(summary_path, "w", newline="")
+    try:
+        writer = csv.writer(summary_file)
+        writer.writerow(["model", "machines"] + conditions_names)
+        for model in sorted(summary):
+            writer.writerow([model] + summary[model])
+    finally:
+        if summary_file is not sys.stderr:
+            summary_file.close()
+
+
+def is_up_to_date(existing, conditions):
+    # Types are compared too, a plist integer 1 is not the boolean True
+    return all(key in existing and type(existing[key]) is type(value) and existing[key] == value
+               for key, value in conditions.items())
+
+
+def update_conditional_items(path, conditions):
+    """
+    Merges conditions into ConditionalItems.plist in one write. Munki runs
+    other condition scripts that update the same file, so the merge happens
+    under a lock and the file is replaced atomically. Nothing is written if
+    every value is already up to date. Returns True if the file was written.
+
+    A file that can't be parsed is overwritten with just these conditions:
+    Munki can't read any of the conditions in it either, and the scripts
+    that own them add them back on their next run.
+    """
+    # Most runs don't change anything, which only takes a read
+    if is_up_to_date(read_plist(path), conditions):
+        return False
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # Read again, another script may have written it in the meantime
+            existing = read_plist(path)
+            if is_up_to_date(existing, conditions):
+                return False
+            existing.update(conditions)
+            write_file_atomically(path, plistlib.dumps(existing))
+            return True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
 
 
 def main(argv=None):
-    bigsur_supported_dict = {}
-
-    # Run the checks
-    model_passed = is_supported_model()
-    board_id_passed = is_supported_board_id()
-    system_version_passed = is_system_version_supported()
-
-    if is_virtual_machine():
-        bigsur_supported = 0
-        bigsur_supported_dict = {'bigsur_supported': True}
-    elif model_passed and board_id_passed and system_version_passed:
-        bigsur_supported = 0
-        bigsur_supported_dict = {'bigsur_supported': True}
-    else:
-        bigsur_supported = 1
-        bigsur_supported_dict = {'bigsur_supported': False}
+    parser = optparse.OptionParser()
+    parser.add_option(
+        '--refresh-facts', action='store_true',
+        help='Probe the hardware again instead of using cached facts.')
+    parser.add_option(
+        '--index', default=compatibility_index_path,
+        help='Compatibility index to read, or to write with --import-assets, defaults to %s.' % compatibility_index_path)
+    parser.add_option(
+        '--import-assets', action='append', default=[], metavar='FILE',
+        help='Compile com_apple_MobileAsset_MacSoftwareUpdate XML or JSON files into the index and exit. '
+             'Can be repeated.')
+    parser.add_option(
+        '--inventory', metavar='FILE',
+        help='Evaluate every machine in a CSV, JSON or JSON lines inventory export (- for stdin) '
+             'instead of this Mac, with columns for model, board_id, os_version and is_virtual_machine.')
+    parser.add_option(
+        '--results', default='-', metavar='FILE',
+        help='With --inventory, write the results per machine as CSV to FILE, defaults to stdout.')
+    parser.add_option(
+        '--summary', metavar='FILE',
+        help='With --inventory, write the number of supported machines per model as CSV to FILE, defaults to stderr.')
+    options, args = parser.parse_args(argv)
+
+    if options.inventory:
+        run_inventory(options.inventory, options.results, options.summary, load_releases(options.index))
+        return 0
+
+    if options.import_assets:
+        definitions = compile_assets([read_asset_catalog(path) for path in options.import_assets])
+        write_index(options.index, definitions)
+        for release in (compile_release(definition) for definition in definitions):
+            logger("Release", release.title, "%d board IDs" % len(release.board_ids))
+        return 0
+
+    cache = FactsCache(facts_cache_path, facts_cache_ttl, get_boot_session())
+    facts = collect_facts(cache, options.refresh_facts)
+
+    # Run the checks for every known release
+    conditions = evaluate_releases(facts, load_releases(options.index))
 
     # Update "ConditionalItems.plist" if munki is installed
-    if munki_installed() and update_munki_conditional_items:
-        append_conditional_items(bigsur_supported_dict)
+    if facts.munki_installed and update_munki_conditional_items:
+        update_conditional_items(conditional_items_path(facts), conditions)
 
     # Exit codes:
-    # 0 = Big Sur is supported
-    # 1 = Big Sur is not supported
-    return bigsur_supported
+    # 0 = exit_code_release (Big Sur) is supported
+    # 1 = exit_code_release (Big Sur) is not supported
+    return 0 if conditions.get("%s_supported" % exit_code_release) else 1
 
 
 if __name__ == '__main__':
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())
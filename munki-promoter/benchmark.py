@@ -0,0 +1,168 @@
+#!/usr/local/autopkg/python
+
+# Benchmarks for munki-promoter, run against a synthetic munki repo.
+#
+# Generates a pkgsinfo tree with a configurable number of files, file size,
+# catalog mix, creation date distribution and directory nesting, then times
+# the scan, evaluate and write phases for every promotion (and for all of
+# them in a single pass). Reports files/sec per phase and peak memory.
+
+import datetime
+import logging
+import optparse
+import os
+import plistlib
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import munki_promoter as promoter
+
+DEFAULT_CATALOG_MIX = 'autopkg=30,test=10,staging=20,production=40'
+
+def parse_catalog_mix(value):
+    # "autopkg=30,production=70" -> ([['autopkg'], ['production']], [30, 70])
+    catalogs = []
+    weights = []
+    for part in value.split(','):
+        catalog, weight = part.split('=')
+        catalogs.append([catalog.strip()])
+        weights.append(float(weight))
+    return catalogs, weights
+
+def get_creation_date(rng, distribution, max_age_days, now):
+    if distribution == 'uniform':
+        age = rng.uniform(0, max_age_days)
+    elif distribution == 'exponential':
+        # Most items are recent, like a repo that autopkg adds to every night
+        age = min(rng.expovariate(5.0 / max_age_days), max_age_days)
+    else:
+        raise ValueError(f'Unknown date distribution "{distribution}"')
+    return now - datetime.timedelta(days=age)
+
+def generate_repo(munki_root, count, size, catalog_mix, distribution, max_age_days, depth, seed):
+    """
+    Generate a synthetic munki repo with count pkgsinfo files of roughly size
+    bytes each, spread over directories nested depth levels deep.
+    """
+    rng = random.Random(seed)
+    catalogs, weights = parse_catalog_mix(catalog_mix)
+    now = datetime.datetime.now().replace(microsecond=0)
+    pkgsinfo_path = os.path.join(munki_root, 'pkgsinfo')
+    for index in range(count):
+        directory = os.path.join(pkgsinfo_path, *[f'dir{(index >> (4 * level)) % 16}' for level in range(depth)])
+        os.makedirs(directory, exist_ok=True)
+        pkginfo = {
+            'name': f'Item{index % max(count // 10, 1)}',
+            'version': f'{index // 1000}.{index % 1000}',
+            'catalogs': rng.choices(catalogs, weights)[0],
+            'installer_item_location': f'apps/Item{index}.dmg',
+            'minimum_os_version': '10.15',
+            '_metadata': {'creation_date': get_creation_date(rng, distribution, max_age_days, now)}
+        }
+        pkginfo['description'] = 'x' * max(size - len(plistlib.dumps(pkginfo)), 0)
+        with open(os.path.join(directory, f'Item{index}-{pkginfo["version"]}.plist'), 'wb') as fp:
+            plistlib.dump(pkginfo, fp)
+    return pkgsinfo_path
+
+def measure(function, trace_memory):
+    # Returns (result, seconds, peak traced bytes or None)
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+def format_row(label, phase, files, seconds, peak):
+    rate = files / seconds if seconds else float('inf')
+    memory = f'{peak / 1048576:.1f} MiB' if peak is not None else '-'
+    return f'{label:<24} {phase:<9} {files:>8} {seconds:>9.3f}s {rate:>12.0f}/s {memory:>12}'
+
+def run_benchmark(options, promotion_names, label):
+    rows = []
+    with tempfile.TemporaryDirectory(prefix='munki-promoter-benchmark-') as munki_root:
+        pkgsinfo_path = generate_repo(munki_root, options.count, options.size, options.catalogs,
+                                      options.dates, options.max_age, options.depth, options.seed)
+
+        plan, seconds, peak = measure(
+            lambda: promoter.plan_promotions(pkgsinfo_path, promotion_names, jobs=options.jobs,
+                                             multi_hop=options.multi_hop), options.memory)
+        rows.append(format_row(label, 'scan', options.count, seconds, peak))
+
+        summaries = [promoter.summarize_pkginfo(promoter.load_pkginfo(fullfile))
+                     for fullfile, file, entry in promoter.find_pkgsinfo_files(pkgsinfo_path)]
+        promotable_count, seconds, peak = measure(
+            lambda: sum(1 for pkginfo in summaries
+                        if promoter.get_promotions(pkginfo, promotion_names, options.multi_hop)), options.memory)
+        rows.append(format_row(label, 'evaluate', len(summaries), seconds, peak))
+
+        found_promotions, seconds, peak = measure(lambda: promoter.apply_promotion_plan(plan), options.memory)
+        rows.append(format_row(label, 'write', len(plan.items), seconds, peak))
+    return rows
+
+def main():
+    """Main"""
+
+    parser = optparse.OptionParser()
+    parser.set_usage('Usage: %prog [options]')
+
+    parser.add_option(
+        '--count', '-c', type='int', default=10000,
+        help='Number of pkgsinfo files to generate, defaults to 10000.')
+    parser.add_option(
+        '--size', type='int', default=2048,
+        help='Approximate size of each pkgsinfo file in bytes, defaults to 2048.')
+    parser.add_option(
+        '--catalogs', default=DEFAULT_CATALOG_MIX,
+        help=f'Weighted catalog mix, defaults to {DEFAULT_CATALOG_MIX}.')
+    parser.add_option(
+        '--dates', default='uniform', choices=['uniform', 'exponential'],
+        help='Distribution of creation dates, uniform or exponential, defaults to uniform.')
+    parser.add_option(
+        '--max-age', type='int', default=60,
+        help='Age in days of the oldest generated item, defaults to 60.')
+    parser.add_option(
+        '--depth', type='int', default=2,
+        help='Directory nesting depth inside pkgsinfo, defaults to 2.')
+    parser.add_option(
+        '--seed', type='int', default=0,
+        help='Random seed, so runs can be compared.')
+    parser.add_option(
+        '--jobs', '-j', type='int', default=1,
+        help='Number of processes to scan with, defaults to 1.')
+    parser.add_option(
+        '--multi-hop', action='store_true',
+        help='Allow items to move through several promotions.')
+    parser.add_option(
+        '--memory', action='store_true',
+        help='Trace peak memory per phase (slows the benchmark down).')
+
+    options, args = parser.parse_args()
+
+    # Keep the per-file promotion logging out of the results
+    logging.disable(logging.INFO)
+    configuration = promoter.load_configuration(promoter.CONFIGURATION_FILE_NAME)
+    promoter.promotion_table = promoter.PromotionTable(
+        promoter.load_promotions(configuration), configuration, promoter.todays_date)
+    promotion_names = [promotion['name'] for promotion in promoter.promotion_table.promotions]
+
+    print(f'{"promotion":<24} {"phase":<9} {"files":>8} {"time":>10} {"rate":>14} {"peak memory":>12}')
+    for name in promotion_names:
+        for row in run_benchmark(options, [name], name):
+            print(row)
+    for row in run_benchmark(options, promotion_names, 'all (single pass)'):
+        print(row)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'Peak RSS: {maxrss / (1048576 if sys.platform == "darwin" else 1024):.1f} MiB')
+
+if __name__ == '__main__':
+    main()
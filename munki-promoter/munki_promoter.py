@@ -0,0 +1,1920 @@
+#!/usr/local/autopkg/python
+
+# author: Jacob Burley <jacob.burley@mollie.com>
+
+# adapted from a script by Arjen van Bochoven (https://github.com/bochoven)
+
+import datetime
+import plistlib
+import logging
+import os
+import sys
+import optparse
+import json
+import collections
+import xml.parsers.expat
+import time
+import re
+import heapq
+import contextlib
+import fnmatch
+import bisect
+import functools
+import select
+import struct
+import signal
+import fcntl
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p',
+                    level=logging.DEBUG,
+                    stream=sys.stdout)
+
+# yaml, certifi, multiprocessing, ctypes, sqlite3, subprocess, hashlib, tempfile,
+# shutil and the urllib/ssl stack are imported where they're used, so runs that
+# don't need them start quicker. xml.parsers.expat is loaded by plistlib anyway.
+
+"""
+The default promotions, used when configuration.yml doesn't define its own
+under a 'promotions' key (in the same format as below).
+
+Promotions form a graph from src to tgt catalogs, which must not contain
+cycles. They are evaluated in topological order, and otherwise in the order
+they are listed. When several promotions run in a single pass, each pkginfo is
+moved by at most one of them, unless --multi-hop is passed.
+
+'after' names the promotion that comes before this one in a chain. The
+deferral of a chained promotion is counted from the creation date of the
+item, so it includes the deferrals of every promotion before it. 'deferral'
+optionally overrides DEFAULT_DEFERRAL_DAYS for a single promotion.
+"""
+promotions=[
+    {
+        'name': 'testtostaging',
+        'src': ['test'],
+        'tgt': ['staging']
+    },
+    {
+        'name': 'autopkgtostaging',
+        'src': ['autopkg'],
+        'tgt': ['staging']
+    },
+    {
+        'name': 'stagingtoproduction',
+        'src': ['staging'],
+        'tgt': ['production'],
+        'after': 'autopkgtostaging'
+    }
+]
+
+todays_date = datetime.datetime.now()
+
+DEFAULT_DEFERRAL_DAYS = 7
+
+_BOOLMAP = {
+    'y': True,
+    'yes': True,
+    't': True,
+    'true': True,
+    'on': True,
+    '1': True,
+    'n': False,
+    'no': False,
+    'f': False,
+    'false': False,
+    'off': False,
+    '0': False
+}
+
+MUNKI_ROOT_PATH='/Users/Shared/munki-repo'
+CONFIGURATION_FILE_NAME = 'configuration.yml'
+# JSON snapshot of configuration.yml, so runs don't have to load yaml while it is unchanged
+CONFIGURATION_CACHE_FILE_NAME = '.configuration.yml.json'
+MUNKI_PKGSINFO_DIR_NAME = 'pkgsinfo'
+# Number of files handed to a worker at a time when scanning with --jobs
+SCAN_BATCH_SIZE = 64
+# Most files between the walk and the evaluation at once, which bounds the memory a scan uses
+SCAN_WINDOW = 1024
+MUNKI_CATALOGS_DIR_NAME = 'catalogs'
+# Identifies plan files written with --plan-out
+PLAN_FORMAT = 'munki-promoter-plan/1'
+# Webhook delivery: seconds before a request times out, attempts per message,
+# and the delay before the first retry, doubled on every following attempt.
+# Retry-After is honoured up to WEBHOOK_MAX_RETRY_AFTER seconds.
+WEBHOOK_TIMEOUT = 10
+WEBHOOK_ATTEMPTS = 4
+WEBHOOK_BACKOFF = 1
+WEBHOOK_MAX_RETRY_AFTER = 60
+# Seconds between scans when watching without inotify, and the longest watch mode sleeps
+POLL_INTERVAL = 30
+WATCH_MAX_SLEEP = 3600
+# Number of slowest files to list in the metrics report
+SLOWEST_FILES_COUNT = 10
+# Slack rejects sections longer than this many characters, and messages with more blocks
+SLACK_SECTION_LIMIT = 3000
+SLACK_BLOCK_LIMIT = 50
+MAKECATALOGS_PATH = '/usr/local/munki/makecatalogs'
+# Parse cache, stored in the munki root next to pkgsinfo
+CACHE_FILE_NAME = '.munki-promoter-cache.sqlite'
+# Seconds to wait for another run that is writing to the cache
+CACHE_BUSY_TIMEOUT = 5
+# Taken in the munki root while writing, and how often to retry it
+LOCK_FILE_NAME = '.munki-promoter.lock'
+LOCK_TIMEOUT = 600
+LOCK_POLL_INTERVAL = 1
+
+
+def strtobool(value):
+    try:
+        return _BOOLMAP[str(value).lower()]
+    except KeyError:
+        raise ValueError('"{}" is not a valid bool value'.format(value))
+
+def user_yes_no_query(question):
+    print(f'{question} [y/n] ', end='')
+    while True:
+        try:
+            return strtobool(input().lower())
+        except ValueError:
+            print('Please respond with \'y\' or \'n\'.\n')
+
+class PromotionTable:
+    """
+    promotions and configuration.yml compiled into lookup tables, so checking
+    a pkginfo is a couple of dict lookups and a datetime comparison.
+    """
+
+    def __init__(self, promotions, deferral_configuration, today):
+        validate_promotions(promotions)
+        self.promotions = sort_promotions(promotions)
+        self.by_name = {promotion['name']: promotion for promotion in self.promotions}
+        self.by_src = {}
+        for promotion in self.promotions:
+            self.by_src.setdefault(tuple(promotion['src']), []).append(promotion)
+
+        # Items without configuration use the default deferral of their promotion
+        self.default_deferrals = {}
+        self.deferrals = {}
+        for promotion in self.promotions:
+            chain = self.get_chain(promotion['name'])
+            chain_defaults = [self.by_name[name].get('deferral', DEFAULT_DEFERRAL_DAYS) for name in chain]
+            chain_configuration = [deferral_configuration.get(name) or {} for name in chain]
+            self.default_deferrals[promotion['name']] = datetime.timedelta(days=sum(chain_defaults))
+            for item_name in set().union(*chain_configuration):
+                deferral = sum(configuration.get(item_name, default)
+                               for configuration, default in zip(chain_configuration, chain_defaults))
+                self.deferrals[(promotion['name'], item_name)] = datetime.timedelta(days=deferral)
+        self.set_today(today)
+
+    def set_today(self, today):
+        # Resolve the deferrals into cutoff dates, items created on or before them are due
+        self.today = today
+        self.default_cutoffs = {name: today - deferral for name, deferral in self.default_deferrals.items()}
+        self.cutoffs = {key: today - deferral for key, deferral in self.deferrals.items()}
+
+    def get_chain(self, promotion_name):
+        # The promotion and every promotion before it, following 'after'
+        chain = []
+        while promotion_name is not None:
+            if promotion_name in chain:
+                raise ValueError(f'Promotion "{promotion_name}" is part of a cycle')
+            if promotion_name not in self.by_name:
+                raise ValueError(f'Promotion "{promotion_name}" does not exist')
+            chain.append(promotion_name)
+            promotion_name = self.by_name[promotion_name].get('after')
+        return chain
+
+    def is_due(self, promotion_name, pkginfo):
+        # Without a creation date there's nothing to count the deferral from, so never due
+        creation_date = (pkginfo.get('_metadata') or {}).get('creation_date')
+        if creation_date is None:
+            return False
+        cutoff = self.cutoffs.get((promotion_name, pkginfo.get('name')), self.default_cutoffs[promotion_name])
+        return creation_date <= cutoff
+
+    def get_promotion(self, pkginfo, promotion_names, catalogs = None):
+        catalogs = pkginfo['catalogs'] if catalogs is None else catalogs
+        for promotion in self.by_src.get(tuple(catalogs), ()):
+            if promotion['name'] in promotion_names and self.is_due(promotion['name'], pkginfo):
+                return promotion
+
+    def get_promotions(self, pkginfo, promotion_names, multi_hop = False):
+        # The promotions to apply to pkginfo in order, following the graph if multi_hop is set
+        hops = []
+        promotion = self.get_promotion(pkginfo, promotion_names)
+        while promotion is not None:
+            hops.append(promotion)
+            if not multi_hop:
+                break
+            promotion = self.get_promotion(pkginfo, promotion_names, promotion['tgt'])
+        return hops
+
+    def is_candidate(self, catalogs, promotion_names):
+        return any(promotion['name'] in promotion_names for promotion in self.by_src.get(tuple(catalogs), ()))
+
+    def get_eligible_date(self, promotion_name, name, creation_date):
+        # When an item created at creation_date becomes due for the promotion
+        deferral = self.deferrals.get((promotion_name, name), self.default_deferrals[promotion_name])
+        return creation_date + deferral
+
+    def get_next_eligible_date(self, record, promotion_names):
+        # The earliest date any of promotion_names applies to a ScanRecord in its current catalogs
+        dates = [self.get_eligible_date(promotion['name'], record.name, record.creation_date)
+                 for promotion in self.by_src.get(tuple(record.catalogs), ())
+                 if promotion['name'] in promotion_names]
+        return min(dates) if dates else None
+
+def get_configuration_key(stat):
+    return [stat.st_mtime_ns, stat.st_size]
+
+def load_configuration(path, use_cache = True):
+    """
+    Load configuration.yml, or its cached JSON snapshot if the file hasn't
+    changed since the snapshot was written. Returns {} if there is no
+    configuration and exits if it can't be parsed.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        logging.warning(f"No {os.path.basename(path)} file was found. Proceeding with defaults...")
+        return {}
+    cache_path = os.path.join(os.path.dirname(path), CONFIGURATION_CACHE_FILE_NAME)
+    if use_cache:
+        try:
+            with open(cache_path, "r") as fp:
+                snapshot = json.load(fp)
+            if snapshot['key'] == get_configuration_key(stat):
+                return snapshot['configuration']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    try:
+        import yaml
+    except ImportError as e:
+        logging.error(e)
+        logging.error("Please install the necessary dependencies with 'python3 -m pip install -r requirements.txt'")
+        sys.exit(1)
+    with open(path, "r") as config_yaml:
+        try:
+            configuration = yaml.safe_load(config_yaml) or {}
+        except yaml.YAMLError as e:
+            logging.error(e)
+            sys.exit(1)
+    if use_cache:
+        # Not every YAML value survives a round trip through JSON (dates, integer keys),
+        # those configurations just aren't cached
+        try:
+            snapshot = json.dumps({'key': get_configuration_key(stat), 'configuration': configuration})
+            if json.loads(snapshot)['configuration'] == configuration:
+                write_text_atomically(cache_path, snapshot)
+        except (OSError, TypeError, ValueError) as e:
+            logging.debug(f"Could not cache {path}: {e}")
+    return configuration
+
+def validate_promotions(promotions):
+    names = set()
+    for promotion in promotions:
+        name = promotion.get('name')
+        if not isinstance(name, str) or not name:
+            raise ValueError(f'Promotion {promotion} has no name')
+        if name in names:
+            raise ValueError(f'Promotion "{name}" is defined more than once')
+        names.add(name)
+        for key in ('src', 'tgt'):
+            catalogs = promotion.get(key)
+            if not isinstance(catalogs, list) or not catalogs or not all(isinstance(c, str) for c in catalogs):
+                raise ValueError(f'Promotion "{name}" needs a list of catalogs as {key}')
+        deferral = promotion.get('deferral', DEFAULT_DEFERRAL_DAYS)
+        if not isinstance(deferral, int) or deferral < 0:
+            raise ValueError(f'Promotion "{name}" has an invalid deferral: {deferral}')
+    for promotion in promotions:
+        if promotion.get('after') is not None and promotion['after'] not in names:
+            raise ValueError(f'Promotion "{promotion["name"]}" comes after unknown promotion "{promotion["after"]}"')
+
+def sort_promotions(promotions):
+    """
+    Order promotions so every promotion comes after the promotions that move
+    items into its src catalogs, keeping the listed order otherwise. Raises a
+    ValueError if the catalogs form a cycle.
+    """
+    upstream = {promotion['name']: {other['name'] for other in promotions if other['tgt'] == promotion['src']}
+                for promotion in promotions}
+    ordered = []
+    remaining = list(promotions)
+    while remaining:
+        done = {promotion['name'] for promotion in ordered}
+        ready = [promotion for promotion in remaining if upstream[promotion['name']] <= done]
+        if not ready:
+            raise ValueError(f'Promotions {", ".join(promotion["name"] for promotion in remaining)} form a cycle')
+        ordered.extend(ready)
+        remaining = [promotion for promotion in remaining if promotion not in ready]
+    return ordered
+
+def load_promotions(configuration):
+    # Promotions from configuration.yml, or the defaults if it doesn't define any
+    configured = configuration.get('promotions')
+    if configured is None:
+        return promotions
+    if not isinstance(configured, list):
+        raise ValueError('promotions in configuration.yml should be a list')
+    return configured
+
+# Built in main() once the configuration is loaded
+promotion_table = None
+
+def promotion_exists(promotion_name):
+    return promotion_name in promotion_table.by_name
+
+def print_promotions():
+    for promotion in promotion_table.promotions:
+        print(f"{promotion['name']}:")
+        print(f"   {', '.join(promotion['src'])} -> {', '.join(promotion['tgt'])}")
+
+def get_promotion_tgt(promotion_name):
+    return promotion_table.by_name[promotion_name]['tgt']
+
+def get_other_promotions(promotion_name):
+    result = []
+    for promotion in promotion_table.promotions:
+        if promotion['name'] != promotion_name:
+            result.append(promotion['name'])
+    return result
+
+def get_promotion_names(requested_names):
+    # Expand repeated and comma-separated --name values, ordered as in promotions
+    names = [name.strip() for value in requested_names for name in value.split(',') if name.strip()]
+    return [promotion['name'] for promotion in promotion_table.promotions if promotion['name'] in names]
+
+def get_unknown_promotion_names(requested_names):
+    names = [name.strip() for value in requested_names for name in value.split(',') if name.strip()]
+    return [name for name in names if not promotion_exists(name)]
+
+def get_promotions(pkginfo, promotion_names, multi_hop = False):
+    return promotion_table.get_promotions(pkginfo, promotion_names, multi_hop)
+
+def is_promotion_candidate(catalogs, promotion_names):
+    return promotion_table.is_candidate(catalogs, promotion_names)
+
+def verify_pkgsinfo_folder(path):
+   # Check that the path for the pkgsinfo exists
+   if not os.path.isdir(path):
+      logging.error("Your pkgsinfo path is not valid. Please check your MUNKI_ROOT_PATH and MUNKI_PKGSINFO_DIR_NAME values.")
+      sys.exit(1)
+   if not os.access(path, os.W_OK):
+      logging.error(f"You don't have access to {path}")
+      sys.exit(1)
+
+class RunMetrics:
+    """
+    Wall time per phase, counters and the slowest files of a run, written out
+    as a JSON report and/or a Prometheus textfile collector file.
+    """
+
+    def __init__(self):
+        self.started = datetime.datetime.now()
+        self.start_time = time.perf_counter()
+        self.phases = {}
+        self.counters = collections.Counter()
+        self.slowest_files = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, value = 1):
+        self.counters[name] += value
+
+    def record_file(self, path, seconds):
+        # Keep the slowest files in a bounded min-heap
+        if len(self.slowest_files) < SLOWEST_FILES_COUNT:
+            heapq.heappush(self.slowest_files, (seconds, path))
+        elif seconds > self.slowest_files[0][0]:
+            heapq.heapreplace(self.slowest_files, (seconds, path))
+
+    def report(self):
+        return {
+            'started': self.started.isoformat(),
+            'duration_seconds': round(time.perf_counter() - self.start_time, 6),
+            'phases': {name: round(seconds, 6) for name, seconds in self.phases.items()},
+            'counters': dict(self.counters),
+            'slowest_files': [{'path': path, 'seconds': round(seconds, 6)}
+                              for seconds, path in sorted(self.slowest_files, reverse=True)]
+        }
+
+    def prometheus(self):
+        report = self.report()
+        lines = [
+            '# HELP munki_promoter_last_run_timestamp_seconds When the last run started.',
+            '# TYPE munki_promoter_last_run_timestamp_seconds gauge',
+            f'munki_promoter_last_run_timestamp_seconds {self.started.timestamp():.3f}',
+            '# HELP munki_promoter_run_duration_seconds Wall time of the last run.',
+            '# TYPE munki_promoter_run_duration_seconds gauge',
+            f'munki_promoter_run_duration_seconds {report["duration_seconds"]}',
+            '# HELP munki_promoter_phase_seconds Time spent per phase in the last run.',
+            '# TYPE munki_promoter_phase_seconds gauge'
+        ]
+        lines += [f'munki_promoter_phase_seconds{{phase="{name}"}} {seconds}' for name, seconds in report['phases'].items()]
+        lines += [
+            '# HELP munki_promoter_count Files, bytes and catalogs handled in the last run.',
+            '# TYPE munki_promoter_count gauge'
+        ]
+        lines += [f'munki_promoter_count{{counter="{name}"}} {value}' for name, value in sorted(report['counters'].items())]
+        return '\n'.join(lines) + '\n'
+
+metrics = RunMetrics()
+
+def write_text_atomically(path, text):
+    import tempfile
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write(text)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def write_metrics(options):
+    try:
+        if options.metrics_file:
+            write_text_atomically(options.metrics_file, json.dumps(metrics.report(), indent=2) + '\n')
+        if options.prometheus_file:
+            write_text_atomically(options.prometheus_file, metrics.prometheus())
+    except OSError as e:
+        logging.error(f"Could not write metrics: {e}")
+
+class PkgsinfoCache:
+    """
+    On-disk index of the pkginfo fields the promoter needs, keyed by path and
+    invalidated whenever a file's mtime, size or inode changes.
+    """
+
+    def __init__(self, cache_path):
+        import sqlite3
+        # Another run may be writing to the cache, wait for it a little before giving up on a query
+        self.connection = sqlite3.connect(cache_path, timeout=CACHE_BUSY_TIMEOUT)
+        try:
+            # The munki root is often a network share, where WAL doesn't work as it needs
+            # shared memory on one host. Set the rollback journal explicitly, as the mode is
+            # stored in the file and caches written by earlier versions may be in WAL mode.
+            self.connection.execute('PRAGMA journal_mode=DELETE')
+        except sqlite3.Error as e:
+            logging.debug(f"Could not set the journal mode of {cache_path}: {e}")
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS pkgsinfo ('
+            'path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, inode INTEGER, '
+            'name TEXT, version TEXT, catalogs TEXT, creation_date TEXT)')
+        # Paths seen by this run, for pruning. Kept by sqlite rather than in memory, as it grows with the repo
+        self.connection.execute('CREATE TEMP TABLE seen (path TEXT PRIMARY KEY)')
+        self.connection.commit()
+        # Set once a scan has walked the whole repo, only then are unseen paths known to be gone
+        self.scan_completed = False
+
+    def mark_seen(self, path):
+        self.connection.execute('INSERT OR IGNORE INTO seen VALUES (?)', (path,))
+
+    # The cache is only ever an optimisation, so errors mean a miss rather than a failed run
+
+    def get(self, path, stat):
+        import sqlite3
+        try:
+            self.mark_seen(path)
+            row = self.connection.execute(
+                'SELECT name, version, catalogs, creation_date FROM pkgsinfo '
+                'WHERE path = ? AND mtime_ns = ? AND size = ? AND inode = ?',
+                (path, stat.st_mtime_ns, stat.st_size, stat.st_ino)).fetchone()
+        except sqlite3.Error as e:
+            logging.debug(f"Cache lookup of {path} failed: {e}")
+            return None
+        if row is None:
+            return None
+        name, version, catalogs, creation_date = row
+        pkginfo = {'name': name, 'version': version, 'catalogs': json.loads(catalogs), '_metadata': {}}
+        # Files skipped by the catalogs pre-filter are only cached with their catalogs
+        if creation_date is not None:
+            pkginfo['_metadata']['creation_date'] = datetime.datetime.fromisoformat(creation_date)
+        return pkginfo
+
+    def put(self, stat, record):
+        # record is a ScanRecord, or anything else with the same fields
+        import sqlite3
+        try:
+            self.mark_seen(record.relpath)
+            self.connection.execute(
+                'INSERT OR REPLACE INTO pkgsinfo VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (record.relpath, stat.st_mtime_ns, stat.st_size, stat.st_ino,
+                 record.name, record.version, json.dumps(list(record.catalogs)),
+                 record.creation_date.isoformat() if record.creation_date is not None else None))
+        except sqlite3.Error as e:
+            logging.debug(f"Could not cache {record.relpath}: {e}")
+
+    def commit(self):
+        # Called after every batch, so the write lock is never held for a whole scan
+        import sqlite3
+        try:
+            self.connection.commit()
+        except sqlite3.Error as e:
+            logging.debug(f"Could not commit the parse cache: {e}")
+            try:
+                self.connection.rollback()
+            except sqlite3.Error:
+                pass
+
+    def close(self, prune = True):
+        # Forget files that have been removed from the repo since the last run,
+        # unless only part of the repo was scanned or the scan was cut short
+        import sqlite3
+        try:
+            if prune and self.scan_completed:
+                self.connection.execute('DELETE FROM pkgsinfo WHERE path NOT IN (SELECT path FROM seen)')
+            self.connection.commit()
+        except sqlite3.Error as e:
+            logging.debug(f"Could not prune the parse cache: {e}")
+        self.connection.close()
+
+def open_pkgsinfo_cache(munki_root):
+    import sqlite3
+    cache_path = os.path.join(munki_root, CACHE_FILE_NAME)
+    try:
+        return PkgsinfoCache(cache_path)
+    except sqlite3.Error as e:
+        logging.warning(f"Could not open the parse cache at {cache_path} ({e}). Proceeding without it...")
+        return None
+
+class _CatalogsRead(Exception):
+    pass
+
+def read_pkginfo_catalogs(fp):
+    """
+    Stream an XML plist just far enough to read the top-level catalogs array.
+    Returns None for binary plists, malformed files or files without catalogs,
+    which should be handed to plistlib instead.
+    """
+    if fp.read(6) == b'bplist':
+        return None
+    fp.seek(0)
+
+    catalogs = []
+    # Elements are nested as plist (1) > dict (2) > key/array (3) > string (4)
+    state = {'depth': 0, 'key': None, 'in_catalogs': False, 'text': []}
+
+    def start_element(tag, attrs):
+        state['depth'] += 1
+        state['text'] = []
+        if state['depth'] == 3 and tag == 'array' and state['key'] == 'catalogs':
+            state['in_catalogs'] = True
+
+    def end_element(tag):
+        depth = state['depth']
+        state['depth'] -= 1
+        if depth == 3 and tag == 'key':
+            state['key'] = ''.join(state['text'])
+        elif depth == 3 and state['in_catalogs']:
+            raise _CatalogsRead()
+        elif depth == 4 and tag == 'string' and state['in_catalogs']:
+            catalogs.append(''.join(state['text']))
+
+    def character_data(data):
+        state['text'].append(data)
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    try:
+        for chunk in iter(lambda: fp.read(16384), b''):
+            parser.Parse(chunk, False)
+        parser.Parse(b'', True)
+    except _CatalogsRead:
+        return catalogs
+    except xml.parsers.expat.ExpatError:
+        pass
+    return None
+
+# What plistlib raises for a file that isn't a valid plist (InvalidFileException is a ValueError)
+PLIST_ERRORS = (ValueError, xml.parsers.expat.ExpatError)
+
+def get_sha256(data):
+    import hashlib
+    return hashlib.sha256(data).hexdigest()
+
+def read_pkginfo_data(fullfile):
+    with open(fullfile, "rb") as fp:
+        data = fp.read()
+    metrics.count('bytes_read', len(data))
+    return data
+
+def parse_pkginfo(data):
+    # For files read again after the scan, to plan, write or catalog them. Scan parses
+    # are counted as files_parsed by record_scan_stats, so the two can be told apart.
+    metrics.count('files_reread')
+    return plistlib.loads(data, fmt=None)
+
+def read_pkginfo(fullfile):
+    # Returns the pkginfo and the SHA-256 of the file's content
+    data = read_pkginfo_data(fullfile)
+    return parse_pkginfo(data), get_sha256(data)
+
+def load_pkginfo(fullfile):
+    return read_pkginfo(fullfile)[0]
+
+def hash_pkginfo(fullfile):
+    return get_sha256(read_pkginfo_data(fullfile))
+
+def stage_plist(fullfile, data):
+    # Write data to a synced temp file next to fullfile, returns the temp file's path
+    import tempfile
+    import shutil
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(fullfile)}.", dir=os.path.dirname(fullfile))
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            plistlib.dump(data, fp, fmt=plistlib.FMT_XML)
+            fp.flush()
+            os.fsync(fp.fileno())
+            metrics.count('bytes_written', fp.tell())
+        if os.path.exists(fullfile):
+            shutil.copymode(fullfile, temp_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return temp_path
+
+def summarize_pkginfo(pkginfo):
+    # The fields the promoter needs to evaluate a pkginfo, in the same shape as a cache entry
+    return {
+        'name': pkginfo['name'],
+        'version': pkginfo['version'],
+        'catalogs': pkginfo['catalogs'],
+        '_metadata': {'creation_date': pkginfo['_metadata']['creation_date']}
+    }
+
+# What a scan keeps of a pkgsinfo file, instead of the whole pkginfo. hops are the names of
+# the promotions that are due and sha256 the hash of the file, for candidates only.
+# name, version and creation_date are None for files ruled out on their catalogs alone.
+ScanRecord = collections.namedtuple('ScanRecord', ['fullfile', 'relpath', 'name', 'version', 'catalogs',
+                                                   'creation_date', 'hops', 'sha256'])
+
+def get_scan_record(fullfile, relpath, pkginfo, hops = (), sha256 = None):
+    # pkginfo can be a full pkginfo, a cache entry or catalogs-only
+    return ScanRecord(fullfile, relpath, pkginfo.get('name'), pkginfo.get('version'), tuple(pkginfo.get('catalogs', ())),
+                      (pkginfo.get('_metadata') or {}).get('creation_date'), tuple(hops), sha256)
+
+def init_scan_worker(table):
+    # Make sure workers evaluate dates and deferrals exactly like the parent process
+    global promotion_table
+    promotion_table = table
+
+ScanStats = collections.namedtuple('ScanStats', ['parse_seconds', 'evaluate_seconds', 'bytes_read', 'parsed'])
+
+def scan_pkgsinfo_file(args):
+    # Returns (ScanRecord, ScanStats). Stats are returned rather than recorded, as this may
+    # run in a worker process. The pkginfo itself is dropped as soon as it is evaluated.
+    fullfile, relpath, promotion_names, multi_hop = args
+    start = time.perf_counter()
+    with open(fullfile, "rb") as fp:
+        catalogs = read_pkginfo_catalogs(fp)
+        if catalogs is not None and not is_promotion_candidate(catalogs, promotion_names):
+            # Most files can be ruled out on their catalogs alone, without a full parse
+            stats = ScanStats(time.perf_counter() - start, 0.0, fp.tell(), False)
+            return ScanRecord(fullfile, relpath, None, None, tuple(catalogs), None, (), None), stats
+        fp.seek(0)
+        data = fp.read()
+    pkginfo = plistlib.loads(data, fmt=None)
+    parsed = time.perf_counter()
+    catalogs = pkginfo.get('catalogs', [])
+    if not is_promotion_candidate(catalogs, promotion_names):
+        # Binary plists skip the pre-filter, keep only what it would have kept
+        stats = ScanStats(parsed - start, 0.0, len(data), True)
+        return ScanRecord(fullfile, relpath, None, None, tuple(catalogs), None, (), None), stats
+    if (pkginfo.get('_metadata') or {}).get('creation_date') is None:
+        logging.warning(f"{fullfile} has no _metadata creation_date, it won't be promoted")
+        stats = ScanStats(parsed - start, 0.0, len(data), True)
+        return ScanRecord(fullfile, relpath, None, None, tuple(catalogs), None, (), None), stats
+    hops = [promotion['name'] for promotion in get_promotions(pkginfo, promotion_names, multi_hop)]
+    stats = ScanStats(parsed - start, time.perf_counter() - parsed, len(data), True)
+    sha256 = get_sha256(data) if hops else None
+    return get_scan_record(fullfile, relpath, pkginfo, hops, sha256), stats
+
+# Which parts of pkgsinfo to scan: glob patterns of files and directories to skip,
+# and optionally the only subdirectories to look in
+ScanScope = collections.namedtuple('ScanScope', ['ignore', 'include'])
+DEFAULT_SCAN_SCOPE = ScanScope((), None)
+
+def load_scan_scope(configuration, extra_ignore = ()):
+    # The 'scan' section of configuration.yml, e.g. {'ignore': ['archive'], 'include': ['apps']}
+    scan_configuration = configuration.get('scan') or {}
+    ignore = tuple(scan_configuration.get('ignore') or ()) + tuple(extra_ignore)
+    include = scan_configuration.get('include')
+    return ScanScope(ignore, tuple(include) if include else None)
+
+def is_ignored(name, relpath, ignore):
+    # Patterns match either the name or the path relative to pkgsinfo
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relpath, pattern) for pattern in ignore)
+
+def find_pkgsinfo_files(pkgsinfo_path, scope = DEFAULT_SCAN_SCOPE):
+    """
+    Yield (fullfile, file, entry) for every pkgsinfo file, where entry is the
+    os.DirEntry of the file so its stat result can be reused. Hidden and
+    ignored directories are pruned without being listed.
+    """
+    if scope.include is None:
+        stack = [pkgsinfo_path]
+    else:
+        stack = []
+        for subdirectory in reversed(scope.include):
+            path = os.path.join(pkgsinfo_path, subdirectory)
+            if os.path.isdir(path):
+                stack.append(path)
+            else:
+                logging.warning(f"{path} does not exist, skipping it.")
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as iterator:
+            entries = sorted(iterator, key=lambda entry: entry.name)
+        subdirectories = []
+        for entry in entries:
+            # Skip files and directories that start with a period
+            if entry.name.startswith("."):
+                continue
+            if scope.ignore and is_ignored(entry.name, os.path.relpath(entry.path, pkgsinfo_path), scope.ignore):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.is_file():
+                yield entry.path, entry.name, entry
+        # Walk subdirectories depth-first, in name order
+        stack.extend(reversed(subdirectories))
+
+def scan_pkgsinfo(pkgsinfo_path, promotion_names, cache = None, jobs = 1, multi_hop = False,
+                  scope = DEFAULT_SCAN_SCOPE, window = SCAN_WINDOW):
+    """
+    Yield a ScanRecord for every pkgsinfo file, in walk order. Files are read
+    in batches, on a process pool if jobs > 1, and at most window files are
+    between the walk and the consumer at any time, so memory use doesn't grow
+    with the size of the repo. Every file is closed as soon as it is read.
+    """
+    walk = find_pkgsinfo_files(pkgsinfo_path, scope)
+    # Smaller batches for windows that wouldn't fit a single one
+    batch_size = max(1, min(SCAN_BATCH_SIZE, window))
+    max_batches = max(1, window // batch_size)
+    in_flight = collections.deque()
+    pool = None
+
+    def next_batch():
+        # [(fullfile, relpath, stat, cached pkginfo or None)], timing the walk on the side
+        batch = []
+        start = time.perf_counter()
+        for fullfile, file, entry in walk:
+            relpath = os.path.relpath(fullfile, pkgsinfo_path)
+            stat = None
+            pkginfo = None
+            if cache is not None:
+                stat = entry.stat()
+                pkginfo = cache.get(relpath, stat)
+                if (pkginfo is not None and 'creation_date' not in pkginfo['_metadata']
+                        and is_promotion_candidate(pkginfo['catalogs'], promotion_names)):
+                    # Only the catalogs of this file were cached, scan it properly now it matters
+                    pkginfo = None
+                if pkginfo is not None:
+                    metrics.count('files_cached')
+            batch.append((fullfile, relpath, stat, pkginfo))
+            if len(batch) == batch_size:
+                break
+        metrics.add_time('walk', time.perf_counter() - start)
+        metrics.count('files_scanned', len(batch))
+        return batch
+
+    def drain():
+        batch, get_results = in_flight.popleft()
+        scanned = iter(get_results())
+        for fullfile, relpath, stat, pkginfo in batch:
+            if pkginfo is None:
+                record, stats = next(scanned)
+                record_scan_stats(fullfile, stats)
+                if cache is not None:
+                    cache.put(stat, record)
+            else:
+                start = time.perf_counter()
+                hops = [promotion['name'] for promotion in get_promotions(pkginfo, promotion_names, multi_hop)]
+                metrics.add_time('evaluate', time.perf_counter() - start)
+                # Cache entries don't have the hash, so read the files that are due
+                record = get_scan_record(fullfile, relpath, pkginfo, hops, hash_pkginfo(fullfile) if hops else None)
+            yield record
+        if cache is not None:
+            cache.commit()
+
+    try:
+        while True:
+            # Only read the next batch once there's room for it in the window
+            batch = next_batch()
+            if not batch:
+                break
+            to_scan = [(fullfile, relpath, promotion_names, multi_hop)
+                       for fullfile, relpath, stat, pkginfo in batch if pkginfo is None]
+            if pool is None and jobs > 1 and len(batch) == batch_size:
+                # Only start workers for repos that fill more than a batch
+                import multiprocessing
+                pool = multiprocessing.Pool(jobs, initializer=init_scan_worker, initargs=(promotion_table,))
+            if pool is not None and to_scan:
+                get_results = pool.map_async(scan_pkgsinfo_file, to_scan, chunksize=len(to_scan)).get
+            else:
+                # Scanned lazily, when the batch is drained
+                get_results = functools.partial(map, scan_pkgsinfo_file, to_scan)
+            in_flight.append((batch, get_results))
+            while len(in_flight) >= max_batches:
+                yield from drain()
+        while in_flight:
+            yield from drain()
+        if cache is not None:
+            cache.scan_completed = True
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+# promotion is the last of hops, the promotions that take the item from its current to its new catalogs.
+# sha256 is the hash of the file's content when it was planned.
+PlannedPromotion = collections.namedtuple('PlannedPromotion', ['fullfile', 'file', 'relpath', 'name', 'version', 'catalogs',
+                                                               'creation_date', 'promotion', 'hops', 'sha256'])
+
+class PromotionPlan:
+    """
+    The promotions found by a scan. Only a few fields of every candidate are
+    kept, the files are read again when the plan is applied.
+    """
+
+    def __init__(self, promotion_names, on_add = None, collect_pending = False):
+        self.promotion_names = promotion_names
+        self.items = []
+        # ScanRecords of candidates that aren't due yet, only kept for the modes that look ahead
+        self.pending = []
+        self.collect_pending = collect_pending
+        # Items that changed on disk and were not promoted when the plan was applied
+        self.conflicts = []
+        # {fullfile: stat key} of the files written when the plan was applied
+        self.written = {}
+        # Called with every item as it is added, to stream results
+        self.on_add = on_add
+
+    def add(self, record, hops):
+        item = PlannedPromotion(record.fullfile, os.path.basename(record.fullfile), record.relpath,
+                                record.name, record.version, record.catalogs, record.creation_date,
+                                hops[-1], hops, record.sha256)
+        self.items.append(item)
+        if self.on_add is not None:
+            self.on_add(item)
+
+    def add_conflict(self, item, reason):
+        logging.warning(f"Not promoting {item.fullfile}, it {reason}")
+        metrics.count('conflicts')
+        self.conflicts.append(item)
+
+    def add_record(self, record):
+        # Sort a ScanRecord into the plan
+        if record.hops:
+            self.add(record, [promotion_table.by_name[name] for name in record.hops])
+        elif self.collect_pending and is_pending(record, self.promotion_names):
+            self.pending.append(record)
+
+    def found_promotions(self):
+        # {promotion name: [[file, name, version], ...]}
+        found_promotions = {name: [] for name in self.promotion_names}
+        for item in self.items:
+            found_promotions[item.promotion['name']].append([item.file, item.name, item.version])
+        return found_promotions
+
+def plan_promotions(pkgsinfo_path, promotion_names, cache = None, jobs = 1, multi_hop = False,
+                    scope = DEFAULT_SCAN_SCOPE, on_add = None, window = SCAN_WINDOW, collect_pending = False):
+    # Walk the repo once for all requested promotions and return a PromotionPlan
+    plan = PromotionPlan(promotion_names, on_add, collect_pending)
+    with metrics.phase('scan'):
+        for record in scan_pkgsinfo(pkgsinfo_path, promotion_names, cache, jobs, multi_hop, scope, window):
+            plan.add_record(record)
+    return plan
+
+def get_plan_record(item):
+    # A planned promotion as JSON, with its path relative to pkgsinfo
+    return {
+        'path': item.relpath,
+        'name': item.name,
+        'version': item.version,
+        'promotion': item.promotion['name'],
+        'hops': [promotion['name'] for promotion in item.hops],
+        'src': item.hops[0]['src'],
+        'tgt': item.promotion['tgt'],
+        'sha256': item.sha256
+    }
+
+class PlanOutput:
+    """
+    Writes planned promotions to stdout as JSON, or as NDJSON with every
+    promotion written as soon as it is found.
+    """
+
+    def __init__(self, output_format):
+        self.output_format = output_format
+        self.records = []
+
+    def add(self, item):
+        record = get_plan_record(item)
+        if self.output_format == 'ndjson':
+            print(json.dumps(record), flush=True)
+        else:
+            self.records.append(record)
+
+    def finish(self):
+        if self.output_format == 'json':
+            print(json.dumps({'promotions': self.records}, indent=2))
+
+def write_plan_file(path, plan):
+    plan_data = {
+        'format': PLAN_FORMAT,
+        'created': datetime.datetime.now().isoformat(),
+        'promotions': [get_plan_record(item) for item in plan.items]
+    }
+    write_text_atomically(path, json.dumps(plan_data, indent=2) + '\n')
+
+def load_plan_file(path, pkgsinfo_path, on_add = None):
+    """
+    Rebuild a plan written with --plan-out, reading only the files in it.
+    Returns the plan and the paths of files that changed since it was made,
+    which are left out of the plan. Raises ValueError for invalid plans.
+    """
+    try:
+        with open(path, "r") as fp:
+            plan_data = json.load(fp)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError(f"Could not read plan {path}: {e}")
+    if not isinstance(plan_data, dict) or plan_data.get('format') != PLAN_FORMAT:
+        raise ValueError(f"{path} is not a munki-promoter plan")
+
+    records = plan_data.get('promotions', [])
+    real_pkgsinfo_path = os.path.realpath(pkgsinfo_path)
+    for record in records:
+        if not isinstance(record, dict) or not all(key in record for key in ('path', 'promotion', 'hops', 'sha256')):
+            raise ValueError(f"{path} has an invalid promotion: {record}")
+        # Plans only ever name files inside pkgsinfo, don't let an edited one write anywhere else
+        if (not isinstance(record['path'], str) or os.path.isabs(record['path']) or
+                os.path.commonpath([real_pkgsinfo_path, os.path.realpath(os.path.join(pkgsinfo_path, record['path']))])
+                != real_pkgsinfo_path):
+            raise ValueError(f"{path} has a promotion outside {pkgsinfo_path}: {record['path']}")
+        hops = record['hops']
+        if (not isinstance(hops, list) or not hops or not all(isinstance(name, str) for name in hops)
+                or record['promotion'] != hops[-1]):
+            raise ValueError(f"{path} has an invalid promotion: {record}")
+        for name in hops:
+            if not promotion_exists(name):
+                raise ValueError(f'Plan {path} uses unknown promotion "{name}"')
+    record_names = {record['promotion'] for record in records}
+    plan = PromotionPlan([promotion['name'] for promotion in promotion_table.promotions
+                          if promotion['name'] in record_names], on_add)
+    changed = []
+    for record in records:
+        fullfile = os.path.join(pkgsinfo_path, record['path'])
+        try:
+            data = read_pkginfo_data(fullfile)
+        except OSError:
+            changed.append(fullfile)
+            continue
+        sha256 = get_sha256(data)
+        if sha256 != record['sha256']:
+            changed.append(fullfile)
+            continue
+        try:
+            pkginfo = parse_pkginfo(data)
+        except PLIST_ERRORS:
+            # The plan was made from a file that parsed, so it's been tampered with
+            changed.append(fullfile)
+            continue
+        plan.add(get_scan_record(fullfile, record['path'], pkginfo, record['hops'], sha256),
+                 [promotion_table.by_name[name] for name in record['hops']])
+    return plan, changed
+
+def is_pending(record, promotion_names):
+    # Catalogs-only records from the pre-filter are never candidates, so they're never pending
+    return record.creation_date is not None and is_promotion_candidate(record.catalogs, promotion_names)
+
+def plan_file_promotions(pkgsinfo_path, fullfiles, promotion_names, cache = None, multi_hop = False):
+    # Like plan_promotions, but only for the given files. Files that no longer exist are skipped.
+    plan = PromotionPlan(promotion_names, collect_pending=True)
+    for fullfile in sorted(fullfiles):
+        relpath = os.path.relpath(fullfile, pkgsinfo_path)
+        try:
+            stat = os.stat(fullfile)
+            record, stats = scan_pkgsinfo_file((fullfile, relpath, promotion_names, multi_hop))
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            logging.error(f"Could not read {fullfile}: {e}")
+            continue
+        record_scan_stats(fullfile, stats)
+        if cache is not None:
+            cache.put(stat, record)
+        plan.add_record(record)
+    return plan
+
+def record_scan_stats(fullfile, stats):
+    # parse and evaluate add up the time spent on each file, also across worker processes
+    metrics.add_time('parse', stats.parse_seconds)
+    metrics.add_time('evaluate', stats.evaluate_seconds)
+    metrics.count('bytes_read', stats.bytes_read)
+    metrics.count('files_parsed' if stats.parsed else 'files_prefiltered')
+    metrics.record_file(fullfile, stats.parse_seconds + stats.evaluate_seconds)
+
+def is_still_due(item, pkginfo, promotion_names):
+    # Whether a pkginfo that changed since it was planned would still get the same promotions
+    hops = get_promotions(pkginfo, promotion_names, len(item.hops) > 1)
+    return [promotion['name'] for promotion in hops] == [promotion['name'] for promotion in item.hops]
+
+def get_stat_key(stat):
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def apply_promotion_plan(plan, cache = None):
+    """
+    Write exactly the promotions in the plan, returns {promotion name: [[file, name, version], ...]}.
+    Every change is staged to a temp file first, so a failure leaves the repo untouched.
+    Files that changed since they were planned are only promoted if they are still due;
+    otherwise they are conflicts, which are left alone and moved from plan.items to plan.conflicts.
+    """
+    with metrics.phase('write'):
+        staged = []
+        try:
+            for item in plan.items:
+                # Only one pkginfo is held at a time, the plan just has the paths
+                try:
+                    stat = os.stat(item.fullfile)
+                    data = read_pkginfo_data(item.fullfile)
+                except OSError as e:
+                    plan.add_conflict(item, f"could not be read again ({e})")
+                    continue
+                # Hashed before parsing, a file that no longer parses has changed by definition
+                sha256 = get_sha256(data)
+                try:
+                    pkginfo = parse_pkginfo(data)
+                except PLIST_ERRORS as e:
+                    plan.add_conflict(item, f"could not be parsed again ({e})")
+                    continue
+                if sha256 != item.sha256:
+                    if not is_still_due(item, pkginfo, plan.promotion_names):
+                        plan.add_conflict(item, "changed since it was scanned")
+                        continue
+                    logging.info(f"{item.fullfile} changed since it was scanned, but is still due")
+                pkginfo['catalogs'] = item.promotion['tgt']
+                staged.append((item, get_stat_key(stat), stage_plist(item.fullfile, pkginfo)))
+        except BaseException:
+            for item, stat_key, temp_path in staged:
+                os.unlink(temp_path)
+            raise
+
+        for item, stat_key, temp_path in staged:
+            # Last check for a write that happened while the changes were staged
+            try:
+                current_key = get_stat_key(os.stat(item.fullfile))
+            except OSError:
+                current_key = None
+            if current_key != stat_key:
+                os.unlink(temp_path)
+                plan.add_conflict(item, "changed while it was being promoted")
+                continue
+            logging.info(f"Promoting {item.fullfile} to {item.promotion['tgt']}")
+            os.replace(temp_path, item.fullfile)
+            metrics.count('files_written')
+            stat = os.stat(item.fullfile)
+            plan.written[item.fullfile] = get_stat_key(stat)
+            if cache is not None:
+                cache.put(stat, item._replace(catalogs=item.promotion['tgt']))
+        if plan.conflicts:
+            conflicted = {item.fullfile for item in plan.conflicts}
+            plan.items = [item for item in plan.items if item.fullfile not in conflicted]
+    return plan.found_promotions()
+
+def get_catalog_entry(pkginfo):
+    # Catalogs hold pkginfo without admin notes or keys starting with an underscore, like makecatalogs
+    return {key: value for key, value in pkginfo.items() if key != 'notes' and not key.startswith('_')}
+
+def write_catalogs(catalogs_path, all_items, catalog_names):
+    os.makedirs(catalogs_path, exist_ok=True)
+    staged = []
+    for catalog_name in sorted(catalog_names):
+        items = [item for item in all_items if catalog_name in item.get('catalogs', [])]
+        staged.append((os.path.join(catalogs_path, catalog_name),
+                       stage_plist(os.path.join(catalogs_path, catalog_name), items)))
+    staged.append((os.path.join(catalogs_path, 'all'), stage_plist(os.path.join(catalogs_path, 'all'), all_items)))
+    for catalog_file, temp_path in staged:
+        logging.info(f"Writing catalog {catalog_file}")
+        os.replace(temp_path, catalog_file)
+        metrics.count('catalogs_written')
+
+def rebuild_all_catalogs(munki_root, pkgsinfo_path, ignore = ()):
+    # Full rebuild from every pkgsinfo file, as makecatalogs would do
+    all_items = []
+    for relpath, fullfile in sorted((os.path.relpath(fullfile, pkgsinfo_path), fullfile)
+                                    for fullfile, file, entry in find_pkgsinfo_files(pkgsinfo_path, ScanScope(ignore, None))):
+        try:
+            pkginfo = load_pkginfo(fullfile)
+        except Exception as e:
+            logging.warning(f"Skipping {fullfile} while building catalogs: {e}")
+            continue
+        all_items.append(get_catalog_entry(pkginfo))
+    catalog_names = {name for item in all_items for name in item.get('catalogs', [])}
+    catalogs_path = os.path.join(munki_root, MUNKI_CATALOGS_DIR_NAME)
+    write_catalogs(catalogs_path, all_items, catalog_names)
+    # Like makecatalogs, remove the catalogs no item is in any more
+    for entry in os.scandir(catalogs_path):
+        if entry.is_file() and not entry.name.startswith('.') and entry.name != 'all' and entry.name not in catalog_names:
+            logging.info(f"Removing catalog {entry.path}, it has no items left")
+            os.unlink(entry.path)
+
+def update_catalogs(munki_root, pkgsinfo_path, plan, ignore = ()):
+    """
+    Update the catalogs for the promotions in an applied plan. Only catalogs
+    that gained or lost items are rewritten. Falls back to a full rebuild
+    when the existing catalogs don't match the pkgsinfo.
+    """
+    if not plan.items:
+        return
+    catalogs_path = os.path.join(munki_root, MUNKI_CATALOGS_DIR_NAME)
+    try:
+        with open(os.path.join(catalogs_path, 'all'), "rb") as fp:
+            all_items = plistlib.load(fp)
+    except (OSError, plistlib.InvalidFileException) as e:
+        logging.warning(f"Could not read the existing catalogs ({e}), rebuilding them all...")
+        return rebuild_all_catalogs(munki_root, pkgsinfo_path, ignore)
+
+    changed_catalogs = set()
+    for item in plan.items:
+        # The plan only has a few fields of every item, read the promoted pkginfo back
+        new_entry = get_catalog_entry(load_pkginfo(item.fullfile))
+        old_entry = dict(new_entry, catalogs=list(item.catalogs))
+        try:
+            all_items[all_items.index(old_entry)] = new_entry
+        except ValueError:
+            logging.warning(f"{item.fullfile} is not in the existing catalogs, rebuilding them all...")
+            return rebuild_all_catalogs(munki_root, pkgsinfo_path, ignore)
+        changed_catalogs.update(item.hops[0]['src'])
+        changed_catalogs.update(item.promotion['tgt'])
+    write_catalogs(catalogs_path, all_items, changed_catalogs)
+
+def run_makecatalogs(munki_root):
+    import subprocess
+    logging.info(f"Running {MAKECATALOGS_PATH} {munki_root}")
+    try:
+        subprocess.run([MAKECATALOGS_PATH, munki_root], check=True, stdout=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.error(f"makecatalogs failed: {e}")
+        return False
+    return True
+
+def print_header(name):
+    print(f"***\n* Promoting the catalogs of the following pkgsinfo files to {get_promotion_tgt(name)}\n***")
+
+def print_found_promotions(promotion_list):
+    for promotion in promotion_list:
+        print(f"{promotion[1]} - {promotion[2]}")
+
+def print_promotion_count(found_promotions):
+    print(f'{sum(len(promotion_list) for promotion_list in found_promotions.values())} pkginfo files promoted')
+
+def print_promotion_not_found(name):
+    print(f'Promotion "{name}" not found, use --list to see valid names.')
+
+Eligibility = collections.namedtuple('Eligibility', ['date', 'promotion_name', 'name', 'version', 'fullfile'])
+
+class EligibilityIndex:
+    """
+    The date every candidate becomes due for each promotion that applies to
+    it, sorted so range queries are a binary search.
+    """
+
+    def __init__(self, plan, promotion_names):
+        entries = []
+        # Planned items and pending ScanRecords have the same fields
+        for candidate in plan.items + plan.pending:
+            for promotion in promotion_table.by_src.get(tuple(candidate.catalogs), ()):
+                if promotion['name'] in promotion_names:
+                    eligible_date = promotion_table.get_eligible_date(promotion['name'], candidate.name,
+                                                                      candidate.creation_date)
+                    entries.append(Eligibility(eligible_date, promotion['name'], candidate.name,
+                                               candidate.version, candidate.fullfile))
+        self.entries = sorted(entries, key=lambda entry: (entry.date, entry.promotion_name, entry.fullfile))
+        self.dates = [entry.date for entry in self.entries]
+
+    def between(self, start, end):
+        # Everything that becomes due after start, up to and including end. start None means any time.
+        low = 0 if start is None else bisect.bisect_right(self.dates, start)
+        return self.entries[low:bisect.bisect_right(self.dates, end)]
+
+    def next_after(self, date):
+        # Everything that becomes due at the first date after date
+        low = bisect.bisect_right(self.dates, date)
+        if low == len(self.dates):
+            return []
+        return self.entries[low:bisect.bisect_right(self.dates, self.dates[low])]
+
+def print_eligibilities(entries):
+    for entry in entries:
+        print(f"{entry.date:%Y-%m-%d %H:%M} - {entry.promotion_name} - {entry.name} - {entry.version}")
+
+def print_schedule(index, now, days):
+    due = index.between(None, now)
+    upcoming = index.between(now, now + datetime.timedelta(days=days))
+    print(f"{len(due)} due now")
+    print_eligibilities(due)
+    print(f"{len(upcoming)} due in the next {days} days")
+    print_eligibilities(upcoming)
+
+def print_next_promotion(index, now):
+    due = index.between(None, now)
+    if due:
+        print(f"{len(due)} due now")
+    upcoming = index.next_after(now)
+    if upcoming:
+        print(f"Next promotion at {upcoming[0].date:%Y-%m-%d %H:%M}:")
+        print_eligibilities(upcoming)
+    elif not due:
+        print("Nothing to promote")
+
+class WebhookError(Exception):
+    pass
+
+class Notifier:
+    """
+    Delivers promotion notifications to every configured sink on a small
+    thread pool, so they can be sent while the rest of the run proceeds.
+    Call wait() before exiting to make sure everything was delivered.
+    """
+
+    def __init__(self, slack_urls, json_urls):
+        self.sinks = [(url, build_slack_payloads) for url in slack_urls]
+        self.sinks += [(url, build_json_payloads) for url in json_urls]
+        self.executor = None
+        self.futures = []
+        self._ssl_context = None
+
+    def ssl_context(self):
+        # Built once and shared by every request
+        if self._ssl_context is None:
+            import ssl
+            try:
+                import certifi
+                self._ssl_context = ssl.create_default_context(cafile=certifi.where())
+            except ImportError:
+                self._ssl_context = ssl.create_default_context()
+        return self._ssl_context
+
+    def notify(self, promotion_name, run_promotions):
+        if not self.sinks or not run_promotions:
+            return
+        if self.executor is None:
+            # Loaded here rather than in the sending threads
+            import concurrent.futures
+            import urllib.request
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.sinks))
+            self.ssl_context()
+        for url, build_payloads in self.sinks:
+            messages = [json.dumps(payload).encode('utf-8') for payload in build_payloads(promotion_name, run_promotions)] #data should be in bytes
+            self.futures.append(self.executor.submit(self.send_all, url, messages))
+
+    def send_all(self, url, messages):
+        # Messages for one sink are sent one after another, so they arrive in order
+        for data in messages:
+            self.send(url, data)
+
+    def send(self, url, data):
+        import http.client
+        import urllib.error
+        import urllib.parse
+        import urllib.request
+        headers = {'Content-Type': 'application/json'}
+        host = urllib.parse.urlsplit(url).netloc
+        for attempt in range(WEBHOOK_ATTEMPTS):
+            delay = WEBHOOK_BACKOFF * 2 ** attempt
+            try:
+                req = urllib.request.Request(url, data, headers)
+                with urllib.request.urlopen(req, timeout=WEBHOOK_TIMEOUT, context=self.ssl_context()) as resp:
+                    resp.read()
+                logging.info(f"Webhook sent successfully to {host}!")
+                return
+            except urllib.error.HTTPError as e:
+                # Client errors other than rate limiting won't get better by retrying
+                if e.code < 500 and e.code != 429:
+                    raise WebhookError(f"HTTP response {e.code} when sending the webhook to {host}.")
+                retry_after = e.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    # A slow sink shouldn't hold up the whole run
+                    delay = max(delay, min(int(retry_after), WEBHOOK_MAX_RETRY_AFTER))
+                error = f"HTTP response {e.code}"
+            except (urllib.error.URLError, OSError) as e:
+                error = str(getattr(e, 'reason', e))
+            except http.client.HTTPException as e:
+                # e.g. IncompleteRead when the connection drops mid-response
+                error = f"{type(e).__name__}: {e}"
+            if attempt + 1 < WEBHOOK_ATTEMPTS:
+                logging.warning(f"Sending the webhook to {host} failed ({error}), retrying in {delay}s...")
+                time.sleep(delay)
+        raise WebhookError(f"Giving up sending the webhook to {host} after {WEBHOOK_ATTEMPTS} attempts ({error}).")
+
+    def wait(self):
+        # Returns False if any notification could not be delivered
+        success = True
+        for future in self.futures:
+            try:
+                future.result()
+            except WebhookError as e:
+                logging.error(e)
+                success = False
+            except Exception as e:
+                # Anything else, e.g. a ValueError for a malformed URL, fails this sink but not the run
+                logging.error(f"Could not send a webhook: {type(e).__name__}: {e}")
+                success = False
+        self.futures = []
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        return success
+
+def get_webhook_urls(variable):
+    # Environment variables can hold several URLs, separated by commas or whitespace
+    return os.environ.get(variable, '').replace(',', ' ').split()
+
+def build_slack_payloads(promotion_name, run_promotions):
+    return build_slack_blocks(get_promotion_tgt(promotion_name)[-1], run_promotions)
+
+def build_json_payloads(promotion_name, run_promotions):
+    return [{
+        'promotion': promotion_name,
+        'catalogs': get_promotion_tgt(promotion_name),
+        'items': [{'file': item[0], 'name': item[1], 'version': item[2]} for item in run_promotions]
+    }]
+
+def version_sort_key(version):
+    # Compare the numeric parts of versions as numbers, so 1.10 sorts after 1.9
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part) for part in re.split(r'(\d+)', str(version)) if part]
+
+def get_slack_lines(run_promotions):
+    # One line per item name, listing its versions or the range they cover
+    versions = {}
+    for item in run_promotions:
+        versions.setdefault(item[1], []).append(item[2])
+    lines = []
+    for name in sorted(versions, key=str.lower):
+        item_versions = sorted(versions[name], key=version_sort_key)
+        if len(item_versions) <= 3:
+            line = f"{name} - {', '.join(item_versions)}"
+        else:
+            line = f"{name} - {item_versions[0]} to {item_versions[-1]} ({len(item_versions)} versions)"
+        lines.append(line[:SLACK_SECTION_LIMIT])
+    return lines
+
+def get_slack_sections(lines):
+    # Pack lines into as few sections as fit within Slack's section limit
+    sections = []
+    section = []
+    length = 0
+    for line in lines:
+        if section and length + len(line) + 1 > SLACK_SECTION_LIMIT:
+            sections.append("\n".join(section))
+            section = []
+            length = 0
+        section.append(line)
+        length += len(line) + 1
+    if section:
+        sections.append("\n".join(section))
+    return sections
+
+def build_slack_blocks(promotion_name, run_promotions):
+    # Returns a list of payloads, split up to stay within Slack's limits
+    sections = get_slack_sections(get_slack_lines(run_promotions))
+    # Leave room for the header, divider and context blocks of each message
+    sections_per_message = SLACK_BLOCK_LIMIT - 3
+    chunks = [sections[i:i + sections_per_message] for i in range(0, len(sections), sections_per_message)]
+    payloads = []
+    for index, chunk in enumerate(chunks):
+        header = f"New items automatically promoted to Munki {promotion_name} catalog!"
+        if len(chunks) > 1:
+            header += f" ({index + 1}/{len(chunks)})"
+        blocks = [{"type": "header", "text": {"type": "plain_text", "text": header}}, {"type": "divider"}]
+        blocks += [{"type": "section", "text": {"type": "mrkdwn", "text": section}} for section in chunk]
+        blocks.append({"type": "context", "elements": [{"type": "mrkdwn", "text": ":monkey_face: This message brought to you by <https://gitlab.molops.io/cit/cpe/munki-promoter|munki-promoter>."}]})
+        payloads.append({'blocks': blocks})
+    return payloads
+
+def find_pkgsinfo_directories(pkgsinfo_path, scope = DEFAULT_SCAN_SCOPE):
+    # pkgsinfo_path and every directory find_pkgsinfo_files descends into
+    roots = [pkgsinfo_path] if scope.include is None else [os.path.join(pkgsinfo_path, path) for path in scope.include]
+    for root_path in roots:
+        for root, dirs, files in os.walk(root_path):
+            dirs[:] = [name for name in dirs if not name.startswith(".") and not
+                       (scope.ignore and is_ignored(name, os.path.relpath(os.path.join(root, name), pkgsinfo_path), scope.ignore))]
+            yield root
+
+class PollingWatcher:
+    """
+    Finds changed pkgsinfo files by comparing stat results between scans.
+    """
+
+    def __init__(self, pkgsinfo_path, scope, interval):
+        self.pkgsinfo_path = pkgsinfo_path
+        self.scope = scope
+        self.interval = interval
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        snapshot = {}
+        for fullfile, file, entry in find_pkgsinfo_files(self.pkgsinfo_path, self.scope):
+            stat = entry.stat()
+            snapshot[fullfile] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        return snapshot
+
+    def wait(self, timeout):
+        # Returns the files that changed, were added or removed
+        time.sleep(max(0, min(timeout, self.interval)))
+        snapshot = self.take_snapshot()
+        changed = {path for path in snapshot.keys() | self.snapshot.keys() if snapshot.get(path) != self.snapshot.get(path)}
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    """
+    Finds changed pkgsinfo files with inotify, Linux only. wait() returns None
+    when events were lost and the whole repo should be scanned again.
+    """
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    EVENT_HEADER_SIZE = 16
+
+    def __init__(self, pkgsinfo_path, scope):
+        self.pkgsinfo_path = pkgsinfo_path
+        self.scope = scope
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+        for directory in find_pkgsinfo_directories(pkgsinfo_path, scope):
+            self.add_watch(directory)
+
+    def get_errno(self):
+        import ctypes
+        return ctypes.get_errno()
+
+    def add_watch(self, directory):
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            logging.warning(f"Could not watch {directory}: {os.strerror(self.get_errno())}")
+        else:
+            self.watches[wd] = directory
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], max(0, timeout))
+        if not readable:
+            return set()
+        data = b''
+        while True:
+            try:
+                data += os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = os.fsdecode(data[offset + self.EVENT_HEADER_SIZE:offset + self.EVENT_HEADER_SIZE + length].rstrip(b'\0'))
+            offset += self.EVENT_HEADER_SIZE + length
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or not name or name.startswith("."):
+                continue
+            path = os.path.join(self.watches[wd], name)
+            if self.scope.ignore and is_ignored(name, os.path.relpath(path, self.pkgsinfo_path), self.scope.ignore):
+                continue
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    # Watch new directories, and pick up files that landed before the watch did
+                    for directory in find_pkgsinfo_directories(path, ScanScope(self.scope.ignore, None)):
+                        self.add_watch(directory)
+                    changed.update(fullfile for fullfile, file, entry in find_pkgsinfo_files(path, ScanScope(self.scope.ignore, None)))
+                continue
+            # A file is only complete once it's closed or moved into place, IN_CREATE is for new directories
+            if mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_MOVED_FROM | self.IN_DELETE):
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+def get_watcher(pkgsinfo_path, scope, poll_interval):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(pkgsinfo_path, scope)
+        except (OSError, AttributeError) as e:
+            logging.warning(f"Could not use inotify ({e}), polling for changes instead.")
+    return PollingWatcher(pkgsinfo_path, scope, poll_interval)
+
+@contextlib.contextmanager
+def repo_lock(munki_root, timeout):
+    """
+    Hold an exclusive lock on the repo, so runs can scan at the same time but
+    write pkgsinfo and catalogs one at a time. Exits if the lock can't be
+    taken within timeout seconds.
+    """
+    lock_path = os.path.join(munki_root, LOCK_FILE_NAME)
+    with open(lock_path, "a") as fp:
+        with metrics.phase('lock'):
+            deadline = time.monotonic() + timeout
+            waiting = False
+            while True:
+                try:
+                    fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        logging.error(f"Timed out waiting for {lock_path}, another run is still writing to the repo.")
+                        sys.exit(1)
+                    if not waiting:
+                        logging.info(f"Waiting for another run to release {lock_path}...")
+                        waiting = True
+                    time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+def write_promotions(options, pkgsinfo_path, plan, scope, cache, notifier = None):
+    # Apply a plan and update the catalogs while holding the repo lock. Notifications
+    # are started as soon as the pkgsinfo are written, and sent while the catalogs are updated.
+    with repo_lock(options.path, options.lock_timeout):
+        run_promotions = apply_promotion_plan(plan, cache)
+        print_promotion_count(run_promotions)
+        if notifier is not None:
+            for name, promotion_list in run_promotions.items():
+                notifier.notify(name, promotion_list)
+        # Returns whether the catalogs could be updated
+        return refresh_catalogs(options, pkgsinfo_path, plan, scope)
+
+def promote(options, pkgsinfo_path, plan, scope, cache, notifier):
+    # Apply a plan, notify about it and update the catalogs.
+    # Returns False if there were conflicts, makecatalogs failed or notifications failed.
+    catalogs_updated = write_promotions(options, pkgsinfo_path, plan, scope, cache, notifier)
+    with metrics.phase('webhook'):
+        notified = notifier.wait()
+    return notified and catalogs_updated and not plan.conflicts
+
+def watch_promotions(options, pkgsinfo_path, promotion_names, scope, cache, notifier):
+    """
+    Keep running, promoting items as soon as they are due. Files are only read
+    again when they change or when the deferral of one of their promotions
+    elapses, which is tracked in a heap ordered by date.
+    """
+    watcher = get_watcher(pkgsinfo_path, scope, options.poll_interval)
+    logging.info(f"Watching {pkgsinfo_path} for changes using {type(watcher).__name__}")
+    schedule = []
+    scheduled = {}
+    # {fullfile: stat key} of the files promoted by this process, whose change events are our own
+    own_writes = {}
+
+    def schedule_record(record, not_before = None):
+        eligible_date = promotion_table.get_next_eligible_date(record, promotion_names)
+        if eligible_date is None:
+            return
+        if not_before is not None:
+            eligible_date = max(eligible_date, not_before)
+        if scheduled.get(record.fullfile) != eligible_date:
+            scheduled[record.fullfile] = eligible_date
+            heapq.heappush(schedule, (eligible_date, record.fullfile))
+
+    def schedule_pending(plan):
+        for record in plan.pending:
+            schedule_record(record)
+        # Promoted items take their next hop in a later iteration, like they would in a later run,
+        # rather than straight away when the watcher reports the write
+        not_before = datetime.datetime.now() + datetime.timedelta(seconds=options.poll_interval)
+        for item in plan.items:
+            if item.fullfile in plan.written:
+                own_writes[item.fullfile] = plan.written[item.fullfile]
+                schedule_record(item._replace(catalogs=tuple(item.promotion['tgt'])), not_before)
+
+    def is_own_write(fullfile):
+        try:
+            stat_key = get_stat_key(os.stat(fullfile))
+        except OSError:
+            stat_key = None
+        if own_writes.get(fullfile) == stat_key:
+            return True
+        own_writes.pop(fullfile, None)
+        return False
+
+    try:
+        promotion_table.set_today(datetime.datetime.now())
+        plan = plan_promotions(pkgsinfo_path, promotion_names, cache, options.jobs, options.multi_hop, scope,
+                               window=options.scan_window, collect_pending=True)
+        while True:
+            if plan.items:
+                promote(options, pkgsinfo_path, plan, scope, cache, notifier)
+            schedule_pending(plan)
+            if cache is not None:
+                cache.commit()
+
+            timeout = WATCH_MAX_SLEEP
+            if schedule:
+                timeout = min(timeout, (schedule[0][0] - datetime.datetime.now()).total_seconds())
+            changed = watcher.wait(timeout)
+
+            now = datetime.datetime.now()
+            promotion_table.set_today(now)
+            if changed is None:
+                logging.warning("Missed some changes, scanning the whole repo again...")
+                schedule.clear()
+                scheduled.clear()
+                own_writes.clear()
+                plan = plan_promotions(pkgsinfo_path, promotion_names, cache, options.jobs, options.multi_hop, scope,
+                                       window=options.scan_window, collect_pending=True)
+                continue
+            changed = {fullfile for fullfile in changed if not is_own_write(fullfile)}
+            while schedule and schedule[0][0] <= now:
+                eligible_date, fullfile = heapq.heappop(schedule)
+                # Entries are stale if the file has been rescheduled since
+                if scheduled.get(fullfile) == eligible_date:
+                    del scheduled[fullfile]
+                    own_writes.pop(fullfile, None)
+                    changed.add(fullfile)
+            for fullfile in changed:
+                scheduled.pop(fullfile, None)
+            plan = plan_file_promotions(pkgsinfo_path, changed, promotion_names, cache, options.multi_hop)
+    finally:
+        watcher.close()
+
+def stop_watching(signum, frame):
+    logging.info("Stopping...")
+    sys.exit(0)
+
+def apply_plan_file(options, pkgsinfo_path, scope, notifier):
+    # --plan-in: apply a plan written with --plan-out, then exit.
+    # Exits with 1 if any planned file changed since the plan was made.
+    output = PlanOutput(options.output) if options.output != 'text' else None
+    try:
+        plan, changed = load_plan_file(options.plan_in, pkgsinfo_path, output.add if output else None)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(1)
+    for fullfile in changed:
+        logging.warning(f"{fullfile} changed since the plan was made, skipping it")
+    if output is not None:
+        output.finish()
+
+    if not plan.items:
+        logging.info('No promotions left in the plan')
+    elif output is not None and not options.auto:
+        # Structured output without --auto only shows the plan
+        pass
+    elif options.auto:
+        with contextlib.redirect_stdout(sys.stderr if output is not None else sys.stdout):
+            if not promote(options, pkgsinfo_path, plan, scope, None, notifier):
+                sys.exit(1)
+    else:
+        for name, promotion_list in plan.found_promotions().items():
+            if promotion_list:
+                print_header(name)
+                print_found_promotions(promotion_list)
+        if user_yes_no_query('Do you want to promote these?'):
+            if not promote(options, pkgsinfo_path, plan, scope, None, notifier):
+                sys.exit(1)
+        else:
+            print('Ok, aborted..')
+            sys.exit(1)
+    sys.exit(1 if changed else 0)
+
+def refresh_catalogs(options, pkgsinfo_path, plan, scope):
+    # Returns False if makecatalogs failed
+    if not plan.items:
+        return True
+    with metrics.phase('catalogs'):
+        if options.rebuild_catalogs:
+            update_catalogs(options.path, pkgsinfo_path, plan, scope.ignore)
+        elif options.makecatalogs:
+            return run_makecatalogs(options.path)
+    return True
+
+def main():
+    """Main"""
+
+    parser = optparse.OptionParser()
+    parser.set_usage('Usage: %prog [options]')
+
+    parser.add_option(
+        '--name', '-n', action='append', default=[],
+        help='Name of promotion to run, use --list to see possible values. '
+             'Can be repeated or comma-separated to run several promotions in one pass.')
+    parser.add_option(
+        '--all', action='store_true',
+        help='Run all promotions in a single pass.')
+    parser.add_option(
+        '--multi-hop', action='store_true',
+        help='Allow an item to move through several promotions in one run, if it is due for all of them.')
+    parser.add_option(
+        '--list', '-l', action='store_true',
+        help='Get list of possible promotions.')
+    parser.add_option(
+        '--path', default=MUNKI_ROOT_PATH,
+        help=f'Optional path to the munki root directory,\ndefaults to {MUNKI_ROOT_PATH}')
+    parser.add_option(
+        '--auto', '-a', action='store_true',
+        help='Run without interaction.')
+    parser.add_option(
+        '--schedule', type='int', metavar='DAYS',
+        help='Show what is due now and what becomes due in the next DAYS days, without promoting anything.')
+    parser.add_option(
+        '--next', action='store_true',
+        help='Show when the next promotion becomes due, without promoting anything.')
+    parser.add_option(
+        '--output', '-o', default='text', choices=['text', 'json', 'ndjson'],
+        help='Output format, text, json or ndjson. With json or ndjson the planned promotions are written '
+             'to stdout and nothing is promoted unless --auto is given.')
+    parser.add_option(
+        '--plan-out', metavar='FILE',
+        help='Write the planned promotions to FILE, to be applied later with --plan-in, without promoting anything.')
+    parser.add_option(
+        '--plan-in', metavar='FILE',
+        help='Apply the promotions planned with --plan-out instead of scanning the repo. '
+             'Files that changed since the plan was made are skipped.')
+    parser.add_option(
+        '--watch', '-w', action='store_true',
+        help='Keep running and promote items as soon as they are due, without interaction.')
+    parser.add_option(
+        '--poll-interval', type='int', default=POLL_INTERVAL,
+        help=f'Seconds between checks for changes in --watch mode when inotify is not available, defaults to {POLL_INTERVAL}.')
+    parser.add_option(
+        '--makecatalogs', action='store_true',
+        help=f'Run {MAKECATALOGS_PATH} once after promoting, if anything was promoted.')
+    parser.add_option(
+        '--rebuild-catalogs', action='store_true',
+        help='Update the catalogs affected by the promotions without running makecatalogs.')
+    parser.add_option(
+        '--lock-timeout', type='int', default=LOCK_TIMEOUT,
+        help=f'Seconds to wait for other runs to finish writing to the repo, defaults to {LOCK_TIMEOUT}.')
+    parser.add_option(
+        '--ignore', action='append', default=[],
+        help='Glob pattern of files or directories in pkgsinfo to skip, can be repeated.')
+    parser.add_option(
+        '--jobs', '-j', type='int', default=1,
+        help='Number of processes to use for parsing pkgsinfo files, defaults to 1.')
+    parser.add_option(
+        '--scan-window', type='int', default=SCAN_WINDOW,
+        help=f'Most pkgsinfo files to hold in memory at once while scanning, defaults to {SCAN_WINDOW}. '
+             'Lower it to bound memory use, raise it to keep more --jobs busy.')
+    parser.add_option(
+        '--metrics-file',
+        help='Write timings and counters for the run to this file as JSON.')
+    parser.add_option(
+        '--prometheus-file',
+        help='Write timings and counters for the run to this file for the Prometheus textfile collector.')
+    parser.add_option(
+        '--no-cache', action='store_true',
+        help=f'Don\'t use or update the pkgsinfo parse cache ({CACHE_FILE_NAME} in the munki root) '
+             f'or the configuration cache ({CONFIGURATION_CACHE_FILE_NAME}).')
+
+    options, args = parser.parse_args()
+    if options.makecatalogs and options.rebuild_catalogs:
+        parser.error('--makecatalogs and --rebuild-catalogs can\'t be used together')
+
+    if options.output != 'text':
+        # Keep stdout for the results
+        logging.getLogger().handlers[0].setStream(sys.stderr)
+
+    configuration = load_configuration(CONFIGURATION_FILE_NAME, not options.no_cache)
+    global promotion_table
+    try:
+        promotion_table = PromotionTable(load_promotions(configuration), configuration, todays_date)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(1)
+    
+    pkgsinfo_path = os.path.join(options.path, MUNKI_PKGSINFO_DIR_NAME)
+    verify_pkgsinfo_folder(pkgsinfo_path)
+    scope = load_scan_scope(configuration, options.ignore)
+
+    notifier = Notifier(get_webhook_urls('SLACK_WEBHOOK'), get_webhook_urls('WEBHOOK_URL'))
+    if not notifier.sinks:
+        logging.warning("The 'SLACK_WEBHOOK' and 'WEBHOOK_URL' environment variables are undefined. Webhooks will not be sent.")
+
+    if options.list:
+        print_promotions()
+        sys.exit(0)
+    
+    querying = options.next or options.schedule is not None
+    if options.all or (querying and not options.name):
+        promotion_names = [promotion['name'] for promotion in promotion_table.promotions]
+    else:
+        unknown_names = get_unknown_promotion_names(options.name)
+        if unknown_names:
+            for name in unknown_names:
+                print_promotion_not_found(name)
+            sys.exit(1)
+        promotion_names = get_promotion_names(options.name)
+
+    if options.plan_in:
+        try:
+            apply_plan_file(options, pkgsinfo_path, scope, notifier)
+        finally:
+            write_metrics(options)
+
+    cache = None
+    if promotion_names and not options.no_cache:
+        cache = open_pkgsinfo_cache(options.path)
+
+    output = None
+    on_add = None
+    if options.output != 'text' and not querying:
+        output = PlanOutput(options.output)
+        on_add = output.add
+
+    try:
+        if querying:
+            plan = plan_promotions(pkgsinfo_path, promotion_names, cache, options.jobs, scope=scope,
+                                   window=options.scan_window, collect_pending=True)
+            index = EligibilityIndex(plan, promotion_names)
+            if options.next:
+                print_next_promotion(index, promotion_table.today)
+            else:
+                print_schedule(index, promotion_table.today, options.schedule)
+            sys.exit(0)
+
+        if promotion_names and options.watch:
+            signal.signal(signal.SIGTERM, stop_watching)
+            try:
+                watch_promotions(options, pkgsinfo_path, promotion_names, scope, cache, notifier)
+            except KeyboardInterrupt:
+                logging.info("Stopping...")
+            sys.exit(0)
+
+        if promotion_names and (options.plan_out or output is not None):
+            plan = plan_promotions(pkgsinfo_path, promotion_names, cache, options.jobs, options.multi_hop, scope, on_add,
+                                   options.scan_window)
+            if output is not None:
+                output.finish()
+            if options.plan_out:
+                write_plan_file(options.plan_out, plan)
+                logging.info(f"Wrote {len(plan.items)} planned promotions to {options.plan_out}")
+                sys.exit(0)
+            if not options.auto:
+                sys.exit(0)
+            with contextlib.redirect_stdout(sys.stderr):
+                promoted = promote(options, pkgsinfo_path, plan, scope, cache, notifier)
+            sys.exit(0 if promoted else 1)
+
+        if promotion_names and options.auto:
+            plan = plan_promotions(pkgsinfo_path, promotion_names, cache, options.jobs, options.multi_hop, scope,
+                                   window=options.scan_window)
+            promoted = promote(options, pkgsinfo_path, plan, scope, cache, notifier)
+            sys.exit(0 if promoted else 1)
+
+        if promotion_names:
+            plan = plan_promotions(pkgsinfo_path, promotion_names, cache, options.jobs, options.multi_hop, scope,
+                                   window=options.scan_window)
+            found_promotions = plan.found_promotions()
+            if any(found_promotions.values()):
+                for name, promotion_list in found_promotions.items():
+                    if promotion_list:
+                        print_header(name)
+                        print_found_promotions(promotion_list)
+                if user_yes_no_query('Do you want to promote these?'):
+                    if not write_promotions(options, pkgsinfo_path, plan, scope, cache) or plan.conflicts:
+                        sys.exit(1)
+                else:
+                    print('Ok, aborted..')
+                    sys.exit(1)
+            else:
+                print('No promotions found')
+        else:
+            parser.print_help()
+    finally:
+        if cache is not None:
+            cache.close(prune=scope.include is None)
+        write_metrics(options)
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file